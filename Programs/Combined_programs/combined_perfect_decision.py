@@ -5,6 +5,7 @@ from pydantic import BaseModel
 import dspy
 from enum import Enum
 from PY_programs.python_tables import PM_PY_no_deep
+from Utils.parallel_enrichment import run_generation
 from SQL_programs.sql_reasoning import PM_SQL_multi_sp
 
 class Decision(str, Enum):
@@ -130,11 +131,12 @@ class PM_combined_perfect_d(dspy.Module):
             else:
                 self.col_tacked[question].append("TN")
             
-            instructions = self.dp_graph.instructions_c(columns_to_generate)
-        #definitions = self.dp_graph.definitions_s(columns_to_generate)
-            for instruction in instructions:
-                print("calling python module cols to generate: ", columns_to_generate)
-                descript = self.pm_py(instruction)
+            #definitions = self.dp_graph.definitions_s(columns_to_generate)
+            # columns of one generation do not depend on each other and are generated concurrently, generations run in dependency order
+            for generation in self.dp_graph.generations(columns_to_generate):
+                print("calling python module cols to generate: ", generation)
+                instructions = self.dp_graph.instructions_c(generation)
+                descript = run_generation(self.pm_py, instructions)
             print("finished calling python, now calling sql module")
             result = self.pm_sql(question)
             return result
@@ -1,9 +1,9 @@
 from pydantic import BaseModel
 import dspy
 from collections import defaultdict
-from queue import Queue
-import threading
 import copy
+from Utils.query_execution import run_query, QUERY_TIMEOUT
+from Utils.result_cache import result_cache_for
 
 
 class CodeOutput(BaseModel):
@@ -56,18 +56,29 @@ class Answering(dspy.Signature):
 
 class PM_isolated(dspy.Module):
 
-    def __init__(self, pool, rm, dp_graph, max_length = 1500):
+    def __init__(self, pool, rm, dp_graph, max_length = 1500, timeout = QUERY_TIMEOUT, use_result_cache = True, check_plan = True, count_total_rows = False):
         super().__init__()
 
         self.pool = pool
         self.dp_graph = dp_graph
         self.max_length = max_length
+        # seconds a generated query may run before sqlite stops it
+        self.timeout = timeout
+        # the same query on an unchanged database returns the cached result table (see result_cache.py)
+        self.use_result_cache = use_result_cache
+        # queries whose plan nests full scans of the event log are sent back to the generator instead of being executed (see query_plan.py)
+        self.check_plan = check_plan
+        # cut off result tables only get their total number of rows in row_counts if asked for, counting runs the query again
+        self.count_total_rows = count_total_rows
         self.generated_query = dspy.Predict(SQL_format)
         self.reasoning = dspy.Predict(Reasoning)
         self.ans = dspy.Predict(Answering)
         self.queries = defaultdict(list)
         self.errors = defaultdict(list)
         self.table = defaultdict(list)
+        self.row_counts = defaultdict(list)
+        # wall and cpu seconds of every executed query
+        self.query_stats = defaultdict(list)
         self.resoning_hist = defaultdict(list)
         self.rm = rm
         
@@ -122,7 +133,6 @@ class PM_isolated(dspy.Module):
         temp_query_hist.append(query)
         self.queries[question].append(query)
         conn = self.pool.get_connection() # insted of self.conn.cursor()
-        cur = conn.cursor()
         result = ""
         #print(f"From SQL: Query that will be executed: {query}")
         cause_error = True
@@ -131,23 +141,14 @@ class PM_isolated(dspy.Module):
             "Query should be distinct from previous queries that resulted in syntax errors: "+ "; ".join(f"{i+1}) {q}" for i, q in enumerate(temp_query_hist)),
         )
         error_code_fail = ""
+        output = None
         try:
-            # add timer here: if cur.execute query takes longer than 5 minutes turn variable overtime to True
-
-            #cur.execute(query)
-            timeout= 60 * 5
-            output = self.execute_query_with_timeout(self.pool, query, timeout)
-            if output is not None:
-                print("output", output)
-                pass
-            else:
-                print("query timed out")
-                raise Exception("Query execution exceeded the time limit. Use a query that executes faster.")
-            
+            # sqlite stops the query on this connection after self.timeout seconds (QueryTimeout)
+            cache = result_cache_for(self.pool.database) if self.use_result_cache else None
+            output = run_query(conn, query, self.max_length, self.timeout, stats=self.query_stats[question], cache=cache, check=self.check_plan, count_total=self.count_total_rows)
         except Exception as e:
             cause_error = False
             error_code_fail = str(e)
-            cur.close()
             self.pool.release_connection(conn)
             self.errors[question].append(str(e))
             #print("Query generator doing error handling")
@@ -164,26 +165,12 @@ class PM_isolated(dspy.Module):
                 self.errors[question].append(str(e))
                 #print(f"From SQL: number of errors: {len(self.errors[question])}")
                 return self.ans(question = question, table = "There was an error during the answering of the question due to the following error: " + str(e), sql = query)
-        try:
-            #column_names = [description[0] for description in cur.description]
-            column_names = [description[0] for description in output[1]]
-        except Exception as e:
-            self.errors[question].append(str(e))
-            return self.ans(question = question, table = "There was an error during the answering of the question due to the following error: " + str(e), sql = query)
-        
-        header = "|".join(column_names)
-        # Initialize result with the header and account for its length.
-        result = header
-        current_length = len(result)
-        #for row in cur.fetchall():
-        for row in output[0]:
-            row_data = " | ".join([str(cell) for cell in row])
-            if current_length + len(row_data) + 1 > self.max_length:
-                break  # Keep within the max_length limit.
-            result += " \n" + row_data
-            current_length += len(row_data) + 1
+        if output is None:
+            return self.ans(question = question, table = "There was an error during the answering of the question due to the following error: " + error_code_fail, sql = query)
+
+        result = output.table
         self.table[question].append(result)
-        cur.close()
+        self.row_counts[question].append(output.total_rows)
         self.pool.release_connection(conn)
         
         try: 
@@ -200,52 +187,6 @@ class PM_isolated(dspy.Module):
         #print(f"From SQL: number of errors: {len(self.errors[question])}")
         #print(f"From SQL: result: {pred.answer}, type: {type(pred.answer)}")
         return pred
-    def execute_query_with_timeout(self, pool, query, timeout):
-        stop_event = threading.Event()
-        result_queue = Queue()
-
-        def target():
-            conn = pool.get_connection()
-            cur = conn.cursor()
-            try:
-                # Register the progress handler
-                def progress_handler():
-                    if stop_event.is_set():
-                        return 1  # Non-zero value to terminate the query
-                    return 0
-
-                conn.set_progress_handler(progress_handler, 1000)  # Call handler every 1000 SQLite instructions
-
-                cur.execute(query)
-                results = []
-                results.append(cur.fetchall())
-                results.append(cur.description)
-                result_queue.put(results)
-                conn.commit()
-                print("Query executed successfully")
-            except Exception as e:
-                print(f"Query execution failed: {e}")
-                result_queue.put(None)
-            finally:
-                cur.close()
-                pool.release_connection(conn)
-
-        thread = threading.Thread(target=target)
-        thread.start()
-
-        # Wait for the specified timeout
-        thread.join(timeout)
-
-        if thread.is_alive():
-            print("Query execution exceeded the time limit.")
-            stop_event.set()  # Signal the thread to stop
-            thread.join()  # Wait for the thread to finish
-            return None
-
-        return result_queue.get()
-
-
-
 
     def __deepcopy__(self, memo):
 
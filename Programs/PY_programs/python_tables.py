@@ -3,7 +3,21 @@ import copy
 import dspy
 from pydantic import BaseModel
 import sqlite3
+import time
 import traceback
+from Utils.event_log_view import new_column_table, column_table, refresh_event_log_view, drop_event_column
+from Utils.generated_code import strip_temp_table_write, strip_add_column, strip_event_log_read, columns_to_load
+from Utils.column_writeback import write_column, add_column, commit_column, savepoint, write_lock_for
+from Utils.db_maintenance import maintenance_for
+from Utils.event_log_frame import frame_cache_for
+from Utils.result_cache import result_cache_for
+from Utils.sandbox import sandbox_executor, GeneratedCodeError, SHARED_FRAME_DIR
+from Utils.enrichment_cache import enrichment_cache_for, program_fingerprint, restore_column
+from Utils.case_templates import match_template, apply_template, PER_CASE_PATTERN
+from Utils.virtual_columns import match_virtual, apply_virtual
+from Utils.column_validation import ColumnChecks, event_log_rows
+from Utils.dataframe_backend import check_backend, POLARS_READ_WRITE, polars_demos, frame_for, result_frame, start_memory_measure, task_peak_mb
+from Utils.event_log_table import CASE_ORDER
 
 def check_beginning(generated):
     # generated must beginn with - '
@@ -56,9 +70,22 @@ class Answer(dspy.Signature):
 
 
 class PM_PY_no_deep(dspy.Module):
-    def __init__(self, rm, conn_path=None, training_mode=False):
+    def __init__(self, rm, conn_path=None, training_mode=False, sandboxed=True, use_enrichment_cache=True, enrichment_cache_dir="enrichment_cache", use_case_templates=False, use_virtual_columns=True, backend="pandas"):
         super().__init__()
         self.training_mode = training_mode
+        # the dataframe library of the generated code: pandas or polars (multithreaded, dp handed over through Arrow), see dataframe_backend.py
+        self.backend = check_backend(backend)
+        # run the generated code in the worker processes of the sandbox executor instead of the notebook process
+        self.sandboxed = sandboxed
+        # restore columns validated in earlier runs instead of generating them again, set to False for fresh generations.
+        # Off in training mode, restored columns leave no traces of the predictors to bootstrap demos from
+        self.use_enrichment_cache = use_enrichment_cache and not training_mode
+        self.enrichment_cache_dir = enrichment_cache_dir
+        # compute instructions of the common per case shapes with one SQL statement, generated code only for the rest.
+        # Off by default: the templates skip the LLM, an evaluation with them on no longer measures the generated code (not in training mode either)
+        self.use_case_templates = use_case_templates and not training_mode
+        # derived columns that only combine enriched columns become expressions of the event_log view, nothing is generated or stored
+        self.use_virtual_columns = use_virtual_columns and not training_mode
         self.conn_path = conn_path
         #self.conn = sqlite3.connect(self.conn_path)
         self.GENERATE = dspy.Predict(Generate)
@@ -85,13 +112,20 @@ class PM_PY_no_deep(dspy.Module):
         dp.to_sql('temp_table', conn, if_exists='replace', index=False)
         conn.commit()
         """
+        if self.backend == "polars":
+            # its own preamble and demos, loading an optimized (pandas) prompt file afterwards replaces the demos
+            self.read_write = POLARS_READ_WRITE
+            self.GENERATE.demos = polars_demos()
         
         self.counter = 0
         self.code = defaultdict(list)
         self.errors = defaultdict(list)
         self.descriptions = defaultdict(list)
+        # per instruction and attempt: backend, seconds the generated code ran and peak memory of the process that ran it
+        self.exec_stats = defaultdict(list)
     def get_connection(self):
-        return sqlite3.connect(self.conn_path)
+        # concurrent enrichments wait for each other's writes instead of failing with "database is locked"
+        return sqlite3.connect(self.conn_path, timeout=60)
 
     def __deepcopy__(self, memo):
         # Create a new instance of the class
@@ -139,13 +173,26 @@ class PM_PY_no_deep(dspy.Module):
     def forward(self, instruction):
         """Generates Python code to generate a new column in the database and returns a description of the column"""
         instruct = self.read_write + "\n" + instruction
-        self.column_description = self.rm.retrieve(instruction)
+        # local copy, the same program instance runs the enrichments of one generation concurrently
+        column_description = self.rm.retrieve(instruction)
+        self.column_description = column_description
         temp_code_hist = []
         conn = self.get_connection()
+        if self.use_case_templates:
+            pred = self.apply_case_template(conn, instruction)
+            if pred is not None:
+                return pred
+        if self.use_virtual_columns:
+            pred = self.apply_virtual_column(conn, instruction)
+            if pred is not None:
+                return pred
+        if self.use_enrichment_cache:
+            enrichment_cache = enrichment_cache_for(self.enrichment_cache_dir)
+            cache_key = enrichment_cache.key(instruction, program_fingerprint(self), enrichment_cache.data_fingerprint(conn, self.conn_path))
+            cached = enrichment_cache.lookup(conn, cache_key)
+            if cached is not None:
+                return self.restore_cached(conn, instruction, *cached)
         extracted = self.EXTRACT(instruction=instruction)
-        pre_float_check = True
-        pre_distinc_value_check = True
-        distinc_values = [(0,), (1,)]
         
 
         dspy.Suggest(
@@ -158,7 +205,7 @@ class PM_PY_no_deep(dspy.Module):
         )
         
             
-        result = self.GENERATE(instruction=instruct, column_description=self.column_description)
+        result = self.GENERATE(instruction=instruct, column_description=column_description)
         cur = conn.cursor()
         #cur.execute("DROP TABLE IF EXISTS temp_table;")
         #conn.commit()
@@ -169,12 +216,27 @@ class PM_PY_no_deep(dspy.Module):
         col_name = extracted.new_column_name
         cur.execute("PRAGMA table_info(event_log);")
         columns_pragma = [info[1] for info in cur.fetchall()]
+        # event_log may be a view over event_log_base and the case table, new columns go into a table behind it
+        table = new_column_table(conn)
 
 
-        if col_name in columns_pragma:
-            # Drop the column if it exists
-            cur.execute(f"ALTER TABLE event_log DROP COLUMN {col_name};")
-            conn.commit()
+        # the full dp.to_sql('temp_table') of the generated code is skipped, only the new column is written back below.
+        # Its ALTER TABLE is skipped as well: the column is added (or the existing one overwritten) in the savepoint of the write back,
+        # so failed or backtracked attempts never change the schema and retries do not drop (rewrite) the column
+        exec_code, declared_type = strip_add_column(strip_temp_table_write(python_code), col_name)
+        # instead of reading the whole event_log, the generated code gets a copy of the cached frame with only the columns it uses
+        exec_code, cached_read = strip_event_log_read(exec_code)
+        if self.backend == "polars":
+            # the polars preamble neither reads the log nor adds the column: dp is always handed over, the program adds the column
+            cached_read = True
+            declared_type = declared_type or ""
+        if col_name in columns_pragma and (declared_type is None or not cached_read):
+            # the code adds the column itself or reads the old values along with the log: drop the column first
+            with write_lock_for(self.conn_path):
+                drop_event_column(conn, col_name)
+            maintenance_for(self.conn_path).record(schema_changes=1)
+            frame_cache_for(self.conn_path).drop_column(col_name)
+            result_cache_for(self.conn_path).bump()
         # if dp in local scope, deleted it
         if "dp" in locals():
             del dp
@@ -183,7 +245,9 @@ class PM_PY_no_deep(dspy.Module):
         col_type = extracted.column_type_in_sql
         self.code[instruction].append(python_code)
         temp_code_hist.append(python_code)
-        commit_to_db = f"""cur.execute('CREATE INDEX idx_case_concept_name_temp_table ON temp_table(case_concept_name);')\nconn.commit()\ncur.execute('ALTER TABLE temp_table ADD COLUMN idt INTEGER;')\nconn.commit()\ncur.execute('''UPDATE temp_table SET idt = (SELECT rowid FROM (SELECT ROW_NUMBER() OVER (ORDER BY case_concept_name, time_timestamp) as seq_num, rowid FROM temp_table) temp WHERE temp.rowid = temp_table.rowid);''')\nconn.commit()\ncur.execute('CREATE INDEX idx_temp_table_idx ON temp_table(idt);')\nconn.commit()\ncur.execute('VACUUM;')\ncur.execute('ANALYZE;')\nconn.commit()\nquery = '''UPDATE event_log SET {col_name} = (SELECT {col_name} FROM temp_table WHERE event_log.idx = temp_table.idt) WHERE EXISTS (SELECT 1 FROM temp_table WHERE event_log.idx = temp_table.idt);'''\ncur.execute(query)\nconn.commit()\ncur.close()"""
+        # one temp table per column, concurrent enrichments do not overwrite each other's values
+        temp_table = f"temp_table_{col_name}"
+        commit_to_db = f"""add_column(conn, {col_name!r}, {declared_type or col_type!r})\ncommit_column(conn, '{col_name}', temp_table='{temp_table}')\ncur.execute('DROP TABLE IF EXISTS {temp_table};')\ncur.close()"""
         self.commit_to_db = commit_to_db
         #\ncur.execute('DROP TABLE temp_table')
         local_scope = {"conn": conn, "cur": cur}
@@ -191,16 +255,49 @@ class PM_PY_no_deep(dspy.Module):
         error_code_fail = ""
         error_col_fail = ""
         formatted_error = ""
+        stats = {"backend": self.backend}
+        start = time.perf_counter()
         try:
-            exec(python_code, globals(), local_scope)
+            # the existing values of a column that is generated again are not handed to the code
+            table_columns = [c for c in columns_pragma if c != col_name]
+            # the column analysis knows pandas code, polars gets all columns
+            load_columns = columns_to_load(exec_code, table_columns, col_name) if cached_read and self.backend == "pandas" else None
+            if cached_read and load_columns is None:
+                load_columns = set(table_columns)
+            if self.sandboxed:
+                frame_path = frame_cache_for(self.conn_path).shared_frame(conn, load_columns, SHARED_FRAME_DIR) if cached_read else None
+                sandbox_dp, sandbox_error = sandbox_executor().run(exec_code, self.conn_path, frame_path, return_columns=["idx", col_name, "case_concept_name"],
+                                                                   backend=self.backend, stats=stats)
+                if sandbox_dp is not None:
+                    local_scope["dp"] = sandbox_dp
+                elif cached_read:
+                    # the worker was stopped, the checks below see the unchanged input like after a failed exec in this process
+                    local_scope["dp"] = frame_cache_for(self.conn_path).frame(conn, ["idx"])
+                if sandbox_error is not None:
+                    raise sandbox_error
+            else:
+                start_mb = start_memory_measure()
+                if cached_read:
+                    local_scope["dp"] = frame_for(self.backend, frame_cache_for(self.conn_path).frame(conn, load_columns))
+                exec(exec_code, globals(), local_scope)
+                stats["peak_rss_mb"] = task_peak_mb(start_mb)
         except Exception as e:
-            tb = traceback.extract_tb(e.__traceback__)
+            tb = e.frames if isinstance(e, GeneratedCodeError) else traceback.extract_tb(e.__traceback__)
             error_code_fail = str(e)
             formatted_error = self.trace_prettyprint(tb, python_code, error_code_fail)
             cause_error = False
             self.errors[instruction].append(formatted_error) # str(e)
             #cur.execute("DROP TABLE IF EXISTS temp_table;")
             #conn.commit()
+        stats["seconds"] = time.perf_counter() - start
+        self.exec_stats[instruction].append(stats)
+        print(f"generated code ({self.backend}) ran in {stats['seconds']:.2f}s")
+        # the checks and the write back work on pandas, a polars dp is converted (only the columns they need)
+        local_scope["dp"] = result_frame(local_scope.get("dp"), ["idx", col_name] + CASE_ORDER)
+
+        if table != "event_log":
+            with write_lock_for(self.conn_path):
+                refresh_event_log_view(conn)
 
         dspy.Suggest(
             cause_error,
@@ -208,30 +305,28 @@ class PM_PY_no_deep(dspy.Module):
             
         )
         cause_error = True
+        # only columns that passed every check below are stored in the enrichment cache
+        validated = not formatted_error
 
 
-        try:
-            dp = local_scope["dp"]
-            dp.to_sql("temp_table", conn, if_exists="replace", index=False)
-            print("length of dp", len(dp))
-        except:
-            pass
+        # all checks run on the dp in memory, a failed attempt writes nothing to the database
+        dp = local_scope.get("dp")
+        # only columns the instruction asks to be the same for every row of a case are checked for one value per case
+        checks = ColumnChecks(dp, col_name, event_log_rows(conn), col_type, per_case=bool(PER_CASE_PATTERN.search(instruction)))
+        print("length of dp", checks.rows)
+        validated = validated and checks.passed
 
         dspy.Suggest(
-                len(dp) == 561470,
-                "Your generated Dataframe has the wrong length, make sure not to shorten dp, expected 561470, received " + str(len(dp)),
+                checks.length_ok,
+                f"Your generated Dataframe has the wrong length, make sure not to shorten dp, expected {checks.expected_rows}, received {checks.rows}",
             )
         
         
-        try:
-            print("column type of new column", dp[col_name].dtype)
-        except Exception as e:
-            
-            error_col_fail = str(e)
+        print("column type of new column", checks.dtype)
+        if not checks.exists:
+            error_col_fail = checks.error
             cause_error = False
-            self.errors[instruction].append(str(e))
-            #cur.execute("DROP TABLE IF EXISTS temp_table;")
-            conn.commit()
+            self.errors[instruction].append(checks.error)
         dspy.Suggest(
             cause_error,
             "New Column was not successfully generated, " + error_col_fail,
@@ -239,42 +334,48 @@ class PM_PY_no_deep(dspy.Module):
         cause_error = True
 
         
-        try:
-            pre_float_check = dp[col_name].dtype == "float64" or dp[col_name].dtype == "object"
-            pre_float_check = not pre_float_check
-            #pre_object_check = not dp[col_name].dtype == "object"
-            #together_check= not pre_float_check == False or not pre_object_check == False
-        except:
-            pass
+        pre_float_check = checks.dtype_ok
         print("pre_float_check", pre_float_check)
         dspy.Suggest(
             pre_float_check,
             "Do not use .apply and lambda functions to create the new column, as those will result in nan values when grouping by case (subsequent column dtype will be float64 or object). Instead use boolean operators first and subsequently group by case, then counring using for example value_counts() or methods that are more robust in avoiding nan values. (fillna(0).astype(int) will most likely also be incorrect.)",
             
         )
-        cur = conn.cursor()
-        try:
-            cur.execute(f"SELECT DISTINCT {col_name} FROM temp_table;")
-            distinc_values = cur.fetchall()
-            pre_distinc_value_check = not any(isinstance(i[0], type(None)) for i in distinc_values)
-        except Exception as e:
-            self.errors[instruction].append(str(e))
-
-            pass
+        pre_distinc_value_check = checks.no_missing
         print("pre_distinc_value_check", pre_distinc_value_check)
         dspy.Suggest(
             pre_distinc_value_check, # sends back to EXTRACT
             "There are nan values present in the new column, this is forbidden, use different transformation in the python code that will avoid resulting in nan values. For example try an alternative to using 'apply' method and lambda functions. Simply using 'fillna(0).astype(int)' will most likely also be wrong (fix the logical error in your approach instead) (i.e using value_counts() or something like that).",
         )
+        print("per_case_check", checks.per_case_ok)
+        dspy.Suggest(
+            checks.per_case_ok,
+            f"The new column {col_name} has more than one distinct value within a case, but the instruction asks for the same value in every row of a case. Compute the value per case (e.g. with groupby('case_concept_name') and transform) so every event of a case gets the same value.",
+        )
+        print("boolean_domain_check", checks.domain_ok)
+        dspy.Suggest(
+            checks.domain_ok,
+            f"The new column is a BOOLEAN column but contains values other than True and False, only output boolean values for {col_name}.",
+        )
 
         try:
-            exec(commit_to_db) # requires a temp table to be present, we overwrite the temp table anyhow whenever python exec is called
+            with write_lock_for(self.conn_path):
+                # temp table, new column and update are committed together or not at all
+                with savepoint(conn):
+                    write_column(conn, dp, col_name, temp_table=temp_table)
+                    exec(commit_to_db) # requires the temp table written above
+            # VACUUM / ANALYZE are deferred to the maintenance scheduler instead of running for every column
+            maintenance_for(self.conn_path).record(schema_changes=1, rows_changed=len(dp))
+            frame_cache_for(self.conn_path).append_column(conn, col_name)
+            # cached results of generated SQL queries were computed without the new column values
+            result_cache_for(self.conn_path).bump()
         except Exception as e:
             self.errors[instruction].append(str(e))
+            validated = False
             pass
         if len(temp_code_hist) > 3:
             python_code = "Error: " + "function failed to execute"
-        pred = self.ANSWER(generated_code=python_code, instruction=instruction, column_description=self.column_description)
+        pred = self.ANSWER(generated_code=python_code, instruction=instruction, column_description=column_description)
         test = len(pred.description) <= 350
         dspy.Suggest(
             test,
@@ -289,10 +390,86 @@ class PM_PY_no_deep(dspy.Module):
         except Exception as e:
             self.errors[instruction].append(str(e))
             return "Error generating the column description"
+        if self.use_enrichment_cache and validated and test and check_beginning(pred.description):
+            try:
+                enrichment_cache.store(conn, cache_key, instruction, col_name, python_code, pred.description)
+            except Exception as e:
+                self.errors[instruction].append(str(e))
         if not self.training_mode:
             self.rm.add_new(pred.description) #turn off during training
         return pred
 
+    def apply_case_template(self, conn, instruction):
+        """Computes the new column in SQLite if the instruction matches a case template (see case_templates.py) and returns its description,
+        None if it does not match or the result is incomplete, then the column is generated as usual"""
+        cur = conn.cursor()
+        cur.execute("PRAGMA table_info(event_log);")
+        template = match_template(instruction, [info[1] for info in cur.fetchall()])
+        cur.close()
+        if template is None:
+            return None
+        try:
+            with write_lock_for(self.conn_path):
+                missing = apply_template(conn, template)
+        except sqlite3.Error as e:
+            self.errors[instruction].append(str(e))
+            missing = None
+        if missing != 0:
+            # rolled back by apply_template, the database is as before
+            print(f"case template for {template.column} left {missing} rows without a value, generating the column instead")
+            return None
+        maintenance_for(self.conn_path).record(schema_changes=1)
+        frame_cache_for(self.conn_path).append_column(conn, template.column)
+        result_cache_for(self.conn_path).bump()
+        pred = dspy.Prediction(description=template.description)
+        self.code[instruction].append(template.code())
+        self.descriptions[instruction].append(pred)
+        if not self.training_mode:
+            self.rm.add_new(pred.description)
+        return pred
+
+    def apply_virtual_column(self, conn, instruction):
+        """Registers the new column as an expression of the event_log view if the instruction only combines enriched columns
+        (see virtual_columns.py) and returns its description, None if it does not match or has missing values, then the column is generated as usual"""
+        cur = conn.cursor()
+        cur.execute("PRAGMA table_info(event_log);")
+        virtual = match_virtual(instruction, [info[1] for info in cur.fetchall()])
+        cur.close()
+        # a stored column of that name is overwritten by the usual path
+        if virtual is None or column_table(conn, virtual.column) is not None:
+            return None
+        try:
+            with write_lock_for(self.conn_path):
+                missing = apply_virtual(conn, virtual)
+        except sqlite3.Error as e:
+            self.errors[instruction].append(str(e))
+            missing = None
+        if missing != 0:
+            print(f"virtual column {virtual.column} has {missing} rows without a value, generating the column instead")
+            return None
+        frame_cache_for(self.conn_path).append_column(conn, virtual.column)
+        result_cache_for(self.conn_path).bump()
+        pred = dspy.Prediction(description=virtual.description)
+        self.code[instruction].append(virtual.code())
+        self.descriptions[instruction].append(pred)
+        if not self.training_mode:
+            self.rm.add_new(pred.description)
+        return pred
+
+    def restore_cached(self, conn, instruction, entry, values):
+        """Writes a column of the enrichment cache back into the database and returns its description like a generated one"""
+        with write_lock_for(self.conn_path):
+            restore_column(conn, entry, values)
+        maintenance_for(self.conn_path).record(schema_changes=1, rows_changed=len(values))
+        frame_cache_for(self.conn_path).append_column(conn, entry["column"])
+        result_cache_for(self.conn_path).bump()
+        pred = dspy.Prediction(description=entry["description"])
+        self.code[instruction].append(entry["code"])
+        self.descriptions[instruction].append(pred)
+        if not self.training_mode:
+            self.rm.add_new(pred.description)
+        return pred
+
     def get_history(self):
         return self.code, self.errors, self.descriptions
 
@@ -2,6 +2,8 @@ from collections import defaultdict
 import copy
 import dspy
 from pydantic import BaseModel
+from Utils.query_execution import run_query, QUERY_TIMEOUT
+from Utils.result_cache import result_cache_for
 
 
 
@@ -55,17 +57,28 @@ class Answering(dspy.Signature):
 
 class PM_SQL_multi_sp(dspy.Module):
 
-    def __init__(self, pool, rm, max_length = 1500):
+    def __init__(self, pool, rm, max_length = 1500, timeout = QUERY_TIMEOUT, use_result_cache = True, check_plan = True, count_total_rows = False):
         super().__init__()
 
         self.pool = pool
         self.max_length = max_length
+        # seconds a generated query may run before sqlite stops it
+        self.timeout = timeout
+        # the same query on an unchanged database returns the cached result table (see result_cache.py)
+        self.use_result_cache = use_result_cache
+        # queries whose plan nests full scans of the event log are sent back to the generator instead of being executed (see query_plan.py)
+        self.check_plan = check_plan
+        # cut off result tables only get their total number of rows in row_counts if asked for, counting runs the query again
+        self.count_total_rows = count_total_rows
         self.generated_query = dspy.Predict(SQL_format)
         self.reasoning = dspy.Predict(Reasoning)
         self.ans = dspy.Predict(Answering)
         self.queries = defaultdict(list)
         self.errors = defaultdict(list)
         self.table = defaultdict(list)
+        self.row_counts = defaultdict(list)
+        # wall and cpu seconds of every executed query
+        self.query_stats = defaultdict(list)
         self.rm = rm
         
     def forward(self, question):
@@ -95,7 +108,6 @@ class PM_SQL_multi_sp(dspy.Module):
         temp_query_hist.append(query)
         self.queries[question].append(query)
         conn = self.pool.get_connection() # insted of self.conn.cursor()
-        cur = conn.cursor()
         result = ""
         #print(f"From SQL: Query that will be executed: {query}")
         cause_error = True
@@ -104,13 +116,13 @@ class PM_SQL_multi_sp(dspy.Module):
             "Query should be distinct from previous queries that resulted in syntax errors: "+ "; ".join(f"{i+1}) {q}" for i, q in enumerate(temp_query_hist)),
         )
         error_code_fail = ""
+        output = None
         try:
-            cur.execute(query)
-            
+            cache = result_cache_for(self.pool.database) if self.use_result_cache else None
+            output = run_query(conn, query, self.max_length, self.timeout, stats=self.query_stats[question], cache=cache, check=self.check_plan, count_total=self.count_total_rows)
         except Exception as e:
             cause_error = False
             error_code_fail = str(e)
-            cur.close()
             self.pool.release_connection(conn)
             self.errors[question].append(str(e))
             #print("Query generator doing error handling")
@@ -128,19 +140,12 @@ class PM_SQL_multi_sp(dspy.Module):
                 #print(f"From SQL: number of errors: {len(self.errors[question])}")
                 return self.ans(question = question, table = "There was an error during the answering of the question due to the following error: " + str(e), sql = query)
 
-        column_names = [description[0] for description in cur.description]
-        header = "|".join(column_names)
-        # Initialize result with the header and account for its length.
-        result = header
-        current_length = len(result)
-        for row in cur.fetchall():
-            row_data = " | ".join([str(cell) for cell in row])
-            if current_length + len(row_data) + 1 > self.max_length:
-                break  # Keep within the max_length limit.
-            result += " \n" + row_data
-            current_length += len(row_data) + 1
+        if output is None:
+            return self.ans(question = question, table = "There was an error during the answering of the question due to the following error: " + error_code_fail, sql = query)
+
+        result = output.table
         self.table[question].append(result)
-        cur.close()
+        self.row_counts[question].append(output.total_rows)
         self.pool.release_connection(conn)
         
         try: 
@@ -0,0 +1,149 @@
+import re
+import time
+from Utils.event_log_view import CASE_TABLE, column_table
+from Utils.column_writeback import add_column, savepoint
+
+CASE_COLUMN = "case_concept_name"
+
+# Create a column called "event_count", ... / Create column called "dismissed", ...
+NAME_PATTERN = re.compile(r'Create (?:a )?column called "(?P<name>\w+)"', re.IGNORECASE)
+# ... the number of times "Send Fine" occurs in the "concept_name" column in a case
+COUNT_PATTERN = re.compile(r'number of times "(?P<value>[^"]+)" occurs in the "(?P<column>\w+)" column in a case')
+# ... counts the number of events per case
+EVENT_COUNT_PATTERN = re.compile(r"counts the number of events per case")
+# ... True if any of the values in a case in the column "concept_name" contain "Add penalty" (OR "..."): "=" matches the value, "contain(s)" a substring
+ANY_PATTERN = re.compile(
+    r'any of the values (?:of a case |in a case )?(?:in|of) (?:the )?(?:column )?"?(?P<column>\w+)"?(?: of a case)?\s*'
+    r'(?P<op>=|contains?)\s+(?:either\s+)?(?P<values>"[^"]+"(?:\s+or\s+"[^"]+")*)',
+    re.IGNORECASE,
+)
+# ... the highest "totalPaymentAmount" value / sums all "expense" values per case / with the lowest "time_timestamp" value
+AGGREGATE_PATTERN = re.compile(r'(?P<agg>highest|lowest|smallest|sums all) "(?P<column>\w+)" values?')
+NONZERO_PATTERN = re.compile(r"which is not (?:Nan, NULL or )?0")
+# the instruction asks for one value per case (also the condition of the cardinality check in column_validation.ColumnChecks)
+PER_CASE_PATTERN = re.compile(r"per case|for every case|in a case|rows of (?:each|a) case|all events pertaining to the same case")
+
+AGGREGATES = {"highest": "MAX", "lowest": "MIN", "smallest": "MIN", "sums all": "SUM"}
+
+
+def _quote(value):
+    # a string literal inside the expression, braces are doubled for the {over} placeholder
+    return "'" + value.replace("'", "''").replace("{", "{{").replace("}", "}}") + "'"
+
+
+class CaseTemplate:
+    """A per case aggregate broadcast to all rows of the case, computed by SQLite with one window function instead of generated pandas code"""
+
+    def __init__(self, column, sql_type, expression, description):
+        self.column = column
+        self.sql_type = sql_type
+        # aggregate over the rows of one case with {over} after the aggregate function, e.g. SUM("concept_name" = 'Payment') {over}
+        self.expression = expression
+        self.description = description
+
+    def select(self):
+        over = f"OVER (PARTITION BY {CASE_COLUMN})"
+        return f"SELECT idx, {self.expression.format(over=over)} AS value FROM event_log"
+
+    def update(self, table):
+        if table == CASE_TABLE:
+            # one row per case: the plain aggregate grouped by case
+            cases = f"SELECT {CASE_COLUMN} AS case_id, {self.expression.format(over='')} AS value FROM event_log GROUP BY {CASE_COLUMN}"
+            return f'UPDATE {table} SET "{self.column}" = t.value FROM ({cases}) AS t WHERE {table}.{CASE_COLUMN} = t.case_id;'
+        return f'UPDATE {table} SET "{self.column}" = t.value FROM ({self.select()}) AS t WHERE {table}.idx = t.idx;'
+
+    def code(self, table="event_log"):
+        # what goes into the code history of the program instead of generated python
+        return f'ALTER TABLE {table} ADD COLUMN "{self.column}" {self.sql_type};\n{self.update(table)}'
+
+
+def _values(text):
+    return re.findall(r'"([^"]+)"', text)
+
+
+def match_template(instruction, table_columns):
+    """The CaseTemplate for instructions of the common shapes (any event of the case has value X, count of value X per case,
+    min / max / sum of a column per case, events per case), None for everything else, which is left to generated code"""
+    name = NAME_PATTERN.search(instruction)
+    if name is None:
+        return None
+    column = name.group("name")
+    is_bool = "boolean" in instruction.lower()
+
+    match = EVENT_COUNT_PATTERN.search(instruction)
+    if match and not is_bool and CASE_COLUMN in table_columns:
+        return CaseTemplate(column, "INTEGER", "COUNT(*) {over}", f"- '{column}' (int): The number of events recorded for each case, the same value for all rows of a case.")
+
+    match = COUNT_PATTERN.search(instruction)
+    if match and not is_bool and match.group("column") in table_columns:
+        value, source = match.group("value"), match.group("column")
+        return CaseTemplate(
+            column, "INTEGER", f'SUM(COALESCE("{source}" = {_quote(value)}, 0)) {{over}}',
+            f"- '{column}' (int): The number of times '{value}' occurs in the '{source}' column within each case, the same value for all rows of a case.",
+        )
+
+    match = ANY_PATTERN.search(instruction)
+    if match and is_bool and match.group("column") in table_columns:
+        values, source = _values(match.group("values")), match.group("column")
+        shown = " or ".join(f"'{v}'" for v in values)
+        if match.group("op") == "=":
+            condition = f'"{source}" IN ({", ".join(_quote(v) for v in values)})'
+            has = f"has {shown} in"
+        else:
+            # contain(s) is a substring match (like str.contains), instr is case sensitive as well
+            condition = " OR ".join(f'instr("{source}", {_quote(v)}) > 0' for v in values)
+            has = f"contains {shown} in"
+        return CaseTemplate(
+            column, "BOOLEAN", f"MAX(COALESCE({condition}, 0)) {{over}}",
+            f"- '{column}' (boolean): TRUE if any event of the case {has} the '{source}' column, FALSE otherwise. The same value for all rows of a case.",
+        )
+
+    match = AGGREGATE_PATTERN.search(instruction)
+    if match and not is_bool and match.group("column") in table_columns and PER_CASE_PATTERN.search(instruction):
+        agg, source = AGGREGATES[match.group("agg")], match.group("column")
+        word = {"MAX": "highest", "MIN": "lowest", "SUM": "sum of the"}[agg]
+        if "datetime" in instruction.lower():
+            if agg == "SUM":
+                return None
+            return CaseTemplate(
+                column, "DATETIME", f'{agg}("{source}") {{over}}',
+                f"- '{column}' (datetime): The {word} '{source}' of the events of each case, the same value for all rows of a case.",
+            )
+        value = f'"{source}"'
+        note = ""
+        if NONZERO_PATTERN.search(instruction):
+            value = f'NULLIF("{source}", 0)'
+            note = " (ignoring 0 and missing values)"
+        return CaseTemplate(
+            column, "INTEGER", f"CAST(COALESCE({agg}({value}) {{over}}, 0) AS INTEGER)",
+            f"- '{column}' (int): The {word} '{source}' values per case{note}, 0 if there are none, the same value for all rows of a case.",
+        )
+    return None
+
+
+class _Incomplete(Exception):
+    pass
+
+
+def apply_template(conn, template):
+    """Adds the column of template to event_log (to the case table if there is one) and fills it with a single UPDATE ... FROM over the aggregate.
+    An existing column is overwritten. Returns the number of rows with a NULL in the column, those results are rolled back (0 if the column is complete).
+    The caller holds the write lock"""
+    start = time.perf_counter()
+    missing = 0
+    try:
+        with savepoint(conn):
+            add_column(conn, template.column, template.sql_type)
+            table = column_table(conn, template.column)
+            cur = conn.cursor()
+            cur.execute(template.update(table))
+            num_rows = cur.rowcount
+            cur.execute(f'SELECT COUNT(*) FROM {table} WHERE "{template.column}" IS NULL;')
+            missing = cur.fetchone()[0]
+            cur.close()
+            if missing:
+                raise _Incomplete()
+    except _Incomplete:
+        return missing
+    print(f"computed {template.column} for {num_rows} rows with a case template in {time.perf_counter() - start:.2f}s")
+    return missing
@@ -169,6 +169,14 @@ class DependencyGraph:
         
         return columns_to_generate
     
+    def generations(self, columns_to_generate):
+        # columns_to_generate grouped into topological generations: the columns of one generation only depend on earlier generations
+        # (or on columns that already exist), so they can be generated at the same time
+        plan = nx.DiGraph()
+        plan.add_nodes_from(columns_to_generate)
+        plan.add_edges_from((u, v) for u, v in self.graph.edges if u in plan and v in plan)
+        return [sorted(generation, key=columns_to_generate.index) for generation in nx.topological_generations(plan)]
+
     def instructions_c(self, columns_to_generate):
         instructions = []
         for col in columns_to_generate:
@@ -0,0 +1,44 @@
+import pandas as pd
+
+
+def event_log_rows(conn):
+    """The number of rows of event_log, what the generated dp has to keep"""
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM event_log;")
+    rows = cur.fetchone()[0]
+    cur.close()
+    return rows
+
+
+class ColumnChecks:
+    """The checks of a generated column, run on the dp the generated code left behind before anything is written to the database:
+    row count against the live event_log, presence of the column, dtype (float64 / object hint at NaN from apply and lambda functions),
+    missing values, for per_case columns (the instruction asks for one value per case, see case_templates.PER_CASE_PATTERN) the cardinality
+    (at most one distinct value per case_concept_name, event level columns may vary within a case) and, for BOOLEAN columns, the domain (at most the two values True / False or 1 / 0)"""
+
+    def __init__(self, dp, column, expected_rows, sql_type=None, per_case=False):
+        self.column = column
+        self.expected_rows = expected_rows
+        self.rows = len(dp) if hasattr(dp, "__len__") else 0
+        self.error = ""
+        series = None
+        try:
+            series = dp[column]
+        except Exception as e:
+            self.error = str(e) if dp is not None else "the generated code did not leave a dataframe dp"
+        self.length_ok = self.rows == expected_rows
+        self.exists = series is not None
+        self.dtype = series.dtype if series is not None else None
+        # a missing column only fails exists, the checks of its values pass
+        self.dtype_ok = series is None or not (pd.api.types.is_float_dtype(series) or pd.api.types.is_object_dtype(series))
+        self.no_missing = series is None or not series.isna().any()
+        self.per_case_ok = True
+        if per_case and series is not None and "case_concept_name" in getattr(dp, "columns", ()):
+            self.per_case_ok = bool(series.groupby(dp["case_concept_name"], sort=False).nunique().le(1).all())
+        self.domain_ok = True
+        if series is not None and str(sql_type).upper() == "BOOLEAN" and not pd.api.types.is_bool_dtype(series):
+            self.domain_ok = bool(series.dropna().isin([0, 1]).all())
+
+    @property
+    def passed(self):
+        return self.length_ok and self.exists and self.dtype_ok and self.no_missing and self.per_case_ok and self.domain_ok
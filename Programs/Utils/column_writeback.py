@@ -0,0 +1,198 @@
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+from Utils.event_log_table import CASE_ORDER
+from Utils.event_log_view import (CASE_TABLE, CASE_KEY, storage_table, column_table, new_column_table, refresh_event_log_view,
+                                  virtual_columns, unregister_virtual_columns)
+
+
+def _sql_type(series):
+    # same declared types pandas.to_sql picks for sqlite
+    if pd.api.types.is_bool_dtype(series):
+        return "INTEGER"
+    if pd.api.types.is_integer_dtype(series):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(series):
+        return "REAL"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "TIMESTAMP"
+    if pd.api.types.is_timedelta64_dtype(series):
+        return "INTEGER"
+    return "TEXT"
+
+
+def row_keys(dp, key="idx"):
+    """The event_log sequence key of every row of dp. Frames read from event_log carry it as a column,
+    otherwise it is recomputed from the (case, timestamp) order event_log is sorted by (ties keep the order of dp)"""
+    if key in dp.columns:
+        return dp[key]
+    order = dp.reset_index(drop=True).sort_values(CASE_ORDER, kind="stable").index
+    keys = pd.Series(0, index=range(len(dp)))
+    keys[order] = range(1, len(dp) + 1)
+    keys.index = dp.index
+    return keys
+
+
+@contextmanager
+def savepoint(conn, name="enrichment"):
+    """Runs the block as one transaction: committed at the end, rolled back if the block raises. Inside a transaction it nests as a savepoint.
+    The write back functions below do not commit inside it, a failed write back leaves neither a column nor a temp table behind"""
+    # IMMEDIATE takes the write lock up front: a deferred transaction that reads first can deadlock with another writer (e.g. ANALYZE)
+    outer = not conn.in_transaction
+    if outer:
+        conn.execute("BEGIN IMMEDIATE;")
+    conn.execute(f"SAVEPOINT {name};")
+    try:
+        yield
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name};")
+        conn.execute(f"RELEASE {name};")
+        if outer:
+            conn.rollback()
+        raise
+    conn.execute(f"RELEASE {name};")
+    if outer:
+        conn.commit()
+
+
+def _commit(conn, nested):
+    if not nested:
+        conn.commit()
+
+
+def _python_values(series):
+    # sqlite3 binds python scalars only: numpy numbers become int / float, timestamps are written like pandas.to_sql writes them, NaN / NaT become NULL
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return [None if pd.isna(v) else str(v) for v in series]
+    if pd.api.types.is_timedelta64_dtype(series):
+        # to_sql stored durations as integer nanoseconds
+        return [None if pd.isna(v) else v.value for v in series]
+    return [None if pd.isna(v) else v for v in series.astype(object).tolist()]
+
+
+def write_column(conn, dp, column, temp_table="temp_table", key="idx"):
+    """Writes only the (idt, column) pairs of dp into a narrow temp_table, with idt as INTEGER PRIMARY KEY so the update joins on the rowid.
+    Replaces the full dp.to_sql(temp_table), which wrote every column of the event log for each new column.
+    temp_table is a TEMP table of the connection: it never touches the database file and takes part in the surrounding savepoint. Returns the number of written rows"""
+    cur = conn.cursor()
+    # dropped first, a failing write must not leave the table of the previous column behind
+    cur.execute(f"DROP TABLE IF EXISTS {temp_table};")
+    pairs = pd.DataFrame({"idt": row_keys(dp, key).to_numpy(), column: dp[column].reset_index(drop=True)})
+    # duplicated rows: the old correlated update took the first match as well
+    pairs = pairs.drop_duplicates("idt", keep="first")
+    cur.execute(f'CREATE TEMP TABLE {temp_table} (idt INTEGER PRIMARY KEY, "{column}" {_sql_type(pairs[column])});')
+    cur.executemany(f"INSERT INTO {temp_table} VALUES (?, ?);", zip(pairs["idt"].astype(int).tolist(), _python_values(pairs[column])))
+    cur.close()
+    return len(pairs)
+
+
+def add_column(conn, column, sql_type):
+    """Adds column to the table new columns go into unless event_log has it already (it is then overwritten). Returns whether it was added"""
+    if column_table(conn, column) is not None:
+        return False
+    if column in virtual_columns(conn):
+        # a virtual column of the view that is materialized now
+        unregister_virtual_columns(conn, [column])
+    table = new_column_table(conn)
+    cur = conn.cursor()
+    cur.execute(f'ALTER TABLE {table} ADD COLUMN "{column}" {sql_type};')
+    cur.close()
+    if table != "event_log":
+        refresh_event_log_view(conn)
+    return True
+
+
+def update_from_temp_table(conn, table, column, temp_table="temp_table", key="idx"):
+    """Copies column from temp_table into table with a single join driven UPDATE ... FROM (one rowid lookup per row of temp_table),
+    instead of the correlated SET (SELECT ...) WHERE EXISTS (SELECT ...) that searched temp_table twice per row. Returns the seconds it took"""
+    start = time.perf_counter()
+    nested = conn.in_transaction
+    cur = conn.cursor()
+    cur.execute(f'UPDATE {table} SET "{column}" = t."{column}" FROM {temp_table} AS t WHERE {table}.{key} = t.idt;')
+    num_rows = cur.rowcount
+    _commit(conn, nested)
+    cur.close()
+    elapsed = time.perf_counter() - start
+    print(f"updated {column} of {num_rows} rows in {table} in {elapsed:.2f}s")
+    return elapsed
+
+
+def is_case_level(conn, column, temp_table="temp_table", key="idx"):
+    """Whether the values in temp_table are the same for all events of every case"""
+    table = storage_table(conn)
+    cur = conn.cursor()
+    cur.execute(
+        f'SELECT 1 FROM {temp_table} AS t JOIN {table} AS b ON b.{key} = t.idt GROUP BY b."{CASE_KEY}" '
+        f'HAVING COUNT(DISTINCT t."{column}") > 1 OR COUNT(t."{column}") NOT IN (0, COUNT(*)) LIMIT 1;'
+    )
+    mixed = cur.fetchone() is not None
+    cur.close()
+    return not mixed
+
+
+def update_case_table(conn, column, temp_table="temp_table", key="idx"):
+    """Copies a case level column from temp_table into the case table, one UPDATE per case instead of one per event. Returns the seconds it took"""
+    start = time.perf_counter()
+    nested = conn.in_transaction
+    table = storage_table(conn)
+    cur = conn.cursor()
+    cur.execute(
+        f'UPDATE {CASE_TABLE} SET "{column}" = v.value FROM '
+        f'(SELECT b."{CASE_KEY}" AS case_id, MIN(t."{column}") AS value FROM {temp_table} AS t JOIN {table} AS b ON b.{key} = t.idt GROUP BY b."{CASE_KEY}") AS v '
+        f'WHERE {CASE_TABLE}."{CASE_KEY}" = v.case_id;'
+    )
+    num_rows = cur.rowcount
+    _commit(conn, nested)
+    cur.close()
+    elapsed = time.perf_counter() - start
+    print(f"updated {column} of {num_rows} cases in {CASE_TABLE} in {elapsed:.2f}s")
+    return elapsed
+
+
+def _move_to_events(conn, column):
+    # the column was added to the case table but differs within a case, it moves to the events table (dropping it rewrites only the small case table)
+    nested = conn.in_transaction
+    table = storage_table(conn)
+    cur = conn.cursor()
+    cur.execute(f"PRAGMA table_info({CASE_TABLE});")
+    sql_type = next(info[2] for info in cur.fetchall() if info[1] == column)
+    cur.execute("DROP VIEW IF EXISTS event_log;")
+    cur.execute(f'ALTER TABLE {CASE_TABLE} DROP COLUMN "{column}";')
+    cur.execute(f'ALTER TABLE {table} ADD COLUMN "{column}" {sql_type};')
+    _commit(conn, nested)
+    cur.close()
+    refresh_event_log_view(conn)
+    print(f"{column} differs within cases, moved it from {CASE_TABLE} to the events")
+
+
+def commit_column(conn, column, temp_table="temp_table", key="idx"):
+    """Writes column from temp_table into the table that holds it. Columns in the case table are checked first,
+    if they are not the same for all events of a case they move to the events table. Returns the seconds the update took"""
+    if column_table(conn, column) == CASE_TABLE:
+        if is_case_level(conn, column, temp_table, key):
+            return update_case_table(conn, column, temp_table, key)
+        _move_to_events(conn, column)
+    return update_from_temp_table(conn, storage_table(conn), column, temp_table, key)
+
+
+def write_frame_column(conn, dp, column, key="idx"):
+    """Writes column of a frame sorted like event_log (e.g. the gold columns of a benchmark) into the event log, adding the column if needed.
+    Rows are matched by row_keys. Returns the number of written rows"""
+    with savepoint(conn, "frame_column"):
+        num_rows = write_column(conn, dp, column, key=key)
+        add_column(conn, column, _sql_type(dp[column]))
+        commit_column(conn, column, key=key)
+    return num_rows
+
+
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def write_lock_for(conn_path):
+    """One lock per database file around the write back of a column (temp table, UPDATE, dropped columns), so concurrent enrichments commit one after the other"""
+    with _write_locks_lock:
+        if conn_path not in _write_locks:
+            _write_locks[conn_path] = threading.RLock()
+        return _write_locks[conn_path]
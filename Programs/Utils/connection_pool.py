@@ -0,0 +1,160 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+# per connection tuning of the read connections: the event log is memory mapped and its hot pages stay in the page cache,
+# temp b-trees of GROUP BY / ORDER BY / DISTINCT are built in memory instead of temp files
+READ_PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # KiB
+    "temp_store": "MEMORY",
+}
+
+
+class PoolTimeout(Exception):
+    """No connection of the pool became free within the acquire timeout"""
+
+
+class SQLiteConnectionPool:
+    """Connections to one database for the SQL programs, which take one per question with get_connection / release_connection (or the
+    connection() context manager). Sized to the threads of Evaluate (num_threads), connections are opened on first use up to max_size.
+    With read_only=True (the default) the connections cannot write: the generated queries only read, and in WAL mode (switched on once by the pool)
+    they neither block nor wait for the column enricher writing to the same file. Wait times and utilization are reported by stats()."""
+
+    def __init__(self, database, max_size=None, num_threads=None, read_only=True, wal=True, acquire_timeout=None, busy_timeout=30,
+                 pragmas=None):
+        self.database = database
+        # one connection per evaluation thread, a thread holds at most one at a time
+        self.max_size = max_size or num_threads or os.cpu_count() or 4
+        self.read_only = read_only
+        self.wal = wal
+        self.acquire_timeout = acquire_timeout
+        self.busy_timeout = busy_timeout
+        self.pragmas = dict(READ_PRAGMAS if pragmas is None else pragmas)
+        # the most recently released connection is handed out first, its page cache is the warmest
+        self.pool = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._checked_out = {}
+        self._wal_checked = False
+        self._created = time.monotonic()
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.peak_in_use = 0
+
+    def create_new_connection(self):
+        if self.wal and not self._wal_checked:
+            self._enable_wal()
+        if self.read_only:
+            uri = f"file:{pathname2url(os.path.abspath(self.database))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=self.busy_timeout)
+        else:
+            conn = sqlite3.connect(self.database, check_same_thread=False, timeout=self.busy_timeout)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    def _enable_wal(self):
+        # the journal mode is stored in the database file, a read only connection cannot switch it
+        if not os.path.exists(self.database):
+            raise FileNotFoundError(f"database {self.database} does not exist")
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout)
+        try:
+            mode = conn.execute("PRAGMA journal_mode = WAL;").fetchone()[0]
+            if mode.lower() != "wal":
+                print(f"{self.database} stays in {mode} journal mode")
+        finally:
+            conn.close()
+        self._wal_checked = True
+
+    def get_connection(self, timeout=None):
+        """A free connection, a new one while fewer than max_size are open. Waits up to timeout seconds (the acquire_timeout of the pool if
+        None, forever if both are None) for one to be released, then raises PoolTimeout"""
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                open_new = self._opened < self.max_size
+                if open_new:
+                    self._opened += 1
+            if open_new:
+                try:
+                    conn = self.create_new_connection()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                try:
+                    conn = self.pool.get(timeout=timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise PoolTimeout(f"no connection to {self.database} became free within {timeout} seconds ({self.max_size} in use)")
+        waited = time.monotonic() - start
+        with self._lock:
+            self.acquired += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            self._checked_out[id(conn)] = time.monotonic()
+            self.peak_in_use = max(self.peak_in_use, len(self._checked_out))
+        return conn
+
+    def release_connection(self, conn):
+        with self._lock:
+            acquired_at = self._checked_out.pop(id(conn), None)
+            if acquired_at is None:
+                # released twice (or never taken from this pool): queued a second time, two threads could get the same connection
+                return
+            self.busy_seconds += time.monotonic() - acquired_at
+        if conn.in_transaction:
+            conn.rollback()
+        self.pool.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """with pool.connection() as conn: ..., released when the block ends (also if it raises)"""
+        conn = self.get_connection(timeout)
+        try:
+            yield conn
+        finally:
+            self.release_connection(conn)
+
+    def stats(self):
+        """Acquisitions, waits for a free connection and utilization (share of the time the connections of the pool were checked out)"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._created
+            busy = self.busy_seconds + sum(now - acquired_at for acquired_at in self._checked_out.values())
+            return {
+                "max_size": self.max_size,
+                "open": self._opened,
+                "in_use": len(self._checked_out),
+                "peak_in_use": self.peak_in_use,
+                "acquired": self.acquired,
+                "timeouts": self.timeouts,
+                "mean_wait_seconds": self.wait_seconds / self.acquired if self.acquired else 0.0,
+                "max_wait_seconds": self.max_wait_seconds,
+                "utilization": busy / (self.max_size * elapsed) if elapsed else 0.0,
+            }
+
+    def close(self):
+        """Closes the free connections"""
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
@@ -0,0 +1,128 @@
+import dspy
+from pydantic import BaseModel
+
+# the dataframe library generated enrichment code is written for, pandas is what the optimized prompts were bootstrapped with
+BACKENDS = ("pandas", "polars")
+
+POLARS_READ_WRITE = """The generated code runs with dp already in its scope: the event_log table as a polars DataFrame (read through Arrow),
+        one row per event ordered by case and timestamp, 0/1 columns as Boolean (except for counts), time_timestamp as Datetime.
+        Do not read the table and do not write to the database, the new column is written back from dp by the program.
+        import polars as pl
+
+        ### Create new column based on the instructions ### Insert polars code here.##
+        # Add the new column with dp = dp.with_columns(...). Never filter, sort, aggregate or join dp itself, it has to keep one row per event in its order.
+        # Values per case are window expressions, e.g. pl.col("amount").max().over("case_concept_name"), instead of group_by followed by a join.
+        # Integer columns must not contain nulls, end them with .fill_null(0).cast(pl.Int64). Boolean columns end with .fill_null(False).
+        """
+
+# (instruction, code) few-shot demos for the GENERATE predictor of the polars backend, the same shapes as the bootstrapped pandas demos
+POLARS_DEMOS = [
+    (
+        'Create a column called "event_count", type int, which counts the number of events per case, make sure this event count is the same for every row in a case',
+        'import polars as pl\n'
+        'dp = dp.with_columns(pl.len().over("case_concept_name").cast(pl.Int64).alias("event_count"))\n',
+    ),
+    (
+        'Create a column called "send_fine_count" which is an integer, defined as the number of times "Send Fine" occurs in the "concept_name" column in a case. '
+        'Make sure the "send_fine_count" is the same value for across all rows of a case.',
+        'import polars as pl\n'
+        'is_send_fine = (pl.col("concept_name") == "Send Fine").fill_null(False).cast(pl.Int64)\n'
+        'dp = dp.with_columns(is_send_fine.sum().over("case_concept_name").fill_null(0).cast(pl.Int64).alias("send_fine_count"))\n',
+    ),
+    (
+        'Create a column called "penalty_added" which is a boolean, TRUE if any of the values in a case in the column "concept_name"contain "Add penalty", '
+        'if not False. Apply the same value across all rows of each case.',
+        'import polars as pl\n'
+        'has_penalty = pl.col("concept_name").str.contains("Add penalty", literal=True).fill_null(False)\n'
+        'dp = dp.with_columns(has_penalty.any().over("case_concept_name").fill_null(False).alias("penalty_added"))\n',
+    ),
+    (
+        'Create a column called "duration" which takes the difference of the "time_timestamp" column of the first and the last event in a case, '
+        'make sure this duration value is the same for every row in a case.',
+        'import polars as pl\n'
+        'span = pl.col("time_timestamp").max() - pl.col("time_timestamp").min()\n'
+        'dp = dp.with_columns(span.over("case_concept_name").dt.total_seconds().fill_null(0).cast(pl.Int64).alias("duration"))\n',
+    ),
+]
+
+
+class _PythonCode(BaseModel):
+    python: str
+
+
+def _polars():
+    try:
+        import polars as pl
+    except ImportError as e:
+        raise ImportError("the polars backend needs polars installed (pip install polars)") from e
+    return pl
+
+
+def check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown dataframe backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == "polars":
+        _polars()
+    return backend
+
+
+def polars_demos():
+    """The POLARS_DEMOS as demos of the GENERATE predictor (instruction and generated_code only, the column descriptions are left out)"""
+    return [dspy.Example(instruction=instruction, generated_code=_PythonCode(python=code)) for instruction, code in POLARS_DEMOS]
+
+
+def frame_for(backend, dp):
+    """The cached pandas frame as the dp of the backend, polars takes it over through Arrow"""
+    if backend == "polars" and dp is not None:
+        return _polars().from_pandas(dp)
+    return dp
+
+
+def read_shared_frame(backend, frame_path):
+    """The shared Arrow file of the event log frame (see event_log_frame.shared_frame) as the dp of the backend, polars takes over the memory mapped columns"""
+    import pyarrow as pa
+    table = pa.ipc.open_file(pa.memory_map(frame_path, "r")).read_all()
+    if backend == "polars":
+        return _polars().from_arrow(table)
+    return table.to_pandas()
+
+
+def result_frame(dp, columns):
+    """What the generated code left in dp, as a pandas frame with only columns (the checks and the write back work on pandas).
+    Anything that is not a polars DataFrame is returned unchanged"""
+    if type(dp).__module__.split(".")[0] != "polars" or not hasattr(dp, "to_pandas"):
+        return dp
+    return dp.select([c for c in dp.columns if c in columns]).to_pandas()
+
+
+def _status_mb(field):
+    # a field of /proc/self/status (linux) in MB, None elsewhere
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def start_memory_measure():
+    """Starts a per task memory measurement for task_peak_mb: resets the high water mark of the resident memory of this process (linux)
+    and returns the resident memory in MB at the start, None where the high water mark cannot be reset"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return None
+    return _status_mb("VmRSS")
+
+
+def task_peak_mb(start_mb):
+    """How far the resident memory of this process rose above start_mb (see start_memory_measure) at its peak, in MB.
+    Comparable between backends and between the sandbox workers (reused for many tasks) and the notebook process, except that enrichments
+    running concurrently in the notebook process are counted together. None if the measurement could not be started"""
+    if start_mb is None:
+        return None
+    peak = _status_mb("VmHWM")
+    return None if peak is None else max(peak - start_mb, 0.0)
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import time
+
+
+class MaintenanceScheduler:
+    """Deferred ANALYZE / VACUUM for a database the column enricher writes to.
+    Every added or dropped column is recorded here instead of running VACUUM and ANALYZE right away (VACUUM rewrites the whole file).
+    ANALYZE runs once analyze_after schema changes have piled up, VACUUM only when the database has been idle for idle_seconds
+    and at least vacuum_free_ratio of its pages are free (dropped columns leave free pages behind)."""
+
+    def __init__(self, conn_path, analyze_after=5, vacuum_free_ratio=0.25, idle_seconds=30):
+        self.conn_path = conn_path
+        self.analyze_after = analyze_after
+        self.vacuum_free_ratio = vacuum_free_ratio
+        self.idle_seconds = idle_seconds
+        self.schema_changes = 0
+        self.rows_changed = 0
+        self.last_change = time.monotonic()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def record(self, schema_changes=0, rows_changed=0):
+        """Called after every write, runs ANALYZE if the threshold is crossed and (re)arms the idle timer"""
+        with self._lock:
+            self.schema_changes += schema_changes
+            self.rows_changed += rows_changed
+            self.last_change = time.monotonic()
+            run_analyze = self.schema_changes >= self.analyze_after
+        if run_analyze:
+            self.analyze()
+        self._schedule_idle()
+
+    def analyze(self):
+        start = time.perf_counter()
+        if not self._execute("ANALYZE;"):
+            return False
+        with self._lock:
+            self.schema_changes = 0
+            self.rows_changed = 0
+        print(f"analyzed {self.conn_path} in {time.perf_counter() - start:.2f}s")
+        return True
+
+    def free_ratio(self):
+        conn = sqlite3.connect(self.conn_path)
+        try:
+            page_count = conn.execute("PRAGMA page_count;").fetchone()[0]
+            freelist_count = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        finally:
+            conn.close()
+        return freelist_count / page_count if page_count else 0.0
+
+    def vacuum(self):
+        start = time.perf_counter()
+        if not self._execute("VACUUM;"):
+            return False
+        print(f"vacuumed {self.conn_path} in {time.perf_counter() - start:.2f}s")
+        return True
+
+    def run_idle(self, force=False):
+        """The deferred work: pending ANALYZE, VACUUM if the file is fragmented enough. force=True runs both regardless of the thresholds"""
+        with self._lock:
+            pending = self.schema_changes > 0 or self.rows_changed > 0
+        if pending or force:
+            self.analyze()
+        if force or self.free_ratio() >= self.vacuum_free_ratio:
+            self.vacuum()
+
+    def _on_idle(self):
+        with self._lock:
+            self._timer = None
+            idle_for = time.monotonic() - self.last_change
+        if idle_for < self.idle_seconds:
+            # another change came in after the timer was armed
+            self._schedule_idle(self.idle_seconds - idle_for)
+            return
+        self.run_idle()
+        with self._lock:
+            postponed = self.schema_changes > 0
+        if postponed:
+            self._schedule_idle()
+
+    def _schedule_idle(self, delay=None):
+        if self.idle_seconds is None:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.idle_seconds if delay is None else delay, self._on_idle)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _execute(self, statement):
+        # maintenance never blocks the programs: if another connection holds a lock, it is retried on the next idle period
+        conn = sqlite3.connect(self.conn_path, timeout=1)
+        try:
+            conn.execute(statement)
+            conn.commit()
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"{statement} on {self.conn_path} postponed: {e}")
+            return False
+        finally:
+            conn.close()
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def maintenance_for(conn_path, **kwargs):
+    """One scheduler per database file, shared by all program instances (and their deepcopies in the evaluation threads)"""
+    with _schedulers_lock:
+        if conn_path not in _schedulers:
+            _schedulers[conn_path] = MaintenanceScheduler(conn_path, **kwargs)
+        return _schedulers[conn_path]
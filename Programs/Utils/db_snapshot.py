@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+from Utils.result_cache import result_cache_for
+from Utils.xes_ingest import CLEANING_VERSION
+
+# one row table in the golden database with the build key it was built from
+BUILD_TABLE = "snapshot_build"
+
+
+def build_key(*sources, **options):
+    """What a golden database is built from: the source files (path, size and modification time, no hashing of the whole log),
+    the options of the build (e.g. the case table, indexes) and the version of the cleaning code"""
+    files = []
+    for source in sources:
+        path = os.path.abspath(source)
+        stat = os.stat(path)
+        files.append([path, stat.st_size, int(stat.st_mtime)])
+    return json.dumps({"sources": files, "options": options, "cleaning_version": CLEANING_VERSION}, sort_keys=True, default=str)
+
+
+class DatabaseSnapshot:
+    """A clean, indexed event log database that is built once and cloned for every run.
+    Clones replace the old reset cells (drop temp_table, to_sql, indexes, idx, VACUUM, ANALYZE), which undo the columns PM_PY_no_deep added."""
+
+    def __init__(self, golden_path):
+        self.golden_path = golden_path
+
+    def exists(self):
+        return os.path.exists(self.golden_path)
+
+    def stored_key(self):
+        """The build key recorded in the golden database, None if it has none"""
+        if not self.exists():
+            return None
+        conn = sqlite3.connect(f"file:{self.golden_path}?mode=ro", uri=True)
+        try:
+            row = conn.execute(f"SELECT key FROM {BUILD_TABLE};").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def build(self, build_fn, rebuild=False, key=None):
+        """Builds the golden database with build_fn(conn) unless it already exists. With a key (see build_key) an existing database is only
+        reused if it was built with the same key, a changed log, cleaning or build option rebuilds it. The file only appears once the build has finished"""
+        if self.exists() and not rebuild:
+            if key is None or self.stored_key() == key:
+                return self.golden_path
+            print(f"{self.golden_path} was built from other inputs, rebuilding it")
+        tmp_path = self.golden_path + ".building"
+        self._remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            build_fn(conn)
+            if key is not None:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {BUILD_TABLE} (key TEXT NOT NULL);")
+                conn.execute(f"DELETE FROM {BUILD_TABLE};")
+                conn.execute(f"INSERT INTO {BUILD_TABLE} VALUES (?);", (key,))
+            conn.commit()
+        finally:
+            conn.close()
+        self._remove(self.golden_path)
+        os.replace(tmp_path, self.golden_path)
+        return self.golden_path
+
+    def apply(self, statements):
+        """Runs statements (e.g. the indexes kept by index_advisor.advise_indexes) on the golden database, so every later clone has them.
+        A rebuild (see build) starts from build_fn again without them"""
+        if not self.exists():
+            raise FileNotFoundError(f"golden database {self.golden_path} has not been built")
+        conn = sqlite3.connect(self.golden_path)
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clone(self, target_path):
+        """Resets target_path to the golden state.
+        Existing databases are overwritten through the sqlite backup API, so connections that are still open (e.g. in a connection pool) see the clean state.
+        New databases are plain file copies."""
+        if not self.exists():
+            raise FileNotFoundError(f"golden database {self.golden_path} has not been built")
+        start = time.perf_counter()
+        if os.path.exists(target_path):
+            source = sqlite3.connect(f"file:{self.golden_path}?mode=ro", uri=True)
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target)
+            finally:
+                source.close()
+                target.close()
+        else:
+            tmp_path = target_path + ".clone"
+            shutil.copyfile(self.golden_path, tmp_path)
+            self._remove(target_path + "-wal")
+            self._remove(target_path + "-shm")
+            self._remove(target_path + "-journal")
+            os.replace(tmp_path, target_path)
+        # cached query results of the enriched database are not served for the clean one
+        result_cache_for(target_path).bump()
+        print(f"reset {target_path} in {time.perf_counter() - start:.2f}s")
+        return target_path
+
+    def clone_for_workers(self, num_workers, directory=None, prefix="worker"):
+        """One isolated copy per worker, so parallel runs never see each other's enriched columns"""
+        if directory is None:
+            directory = os.path.dirname(os.path.abspath(self.golden_path))
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for i in range(num_workers):
+            paths.append(self.clone(os.path.join(directory, f"{prefix}_{i}.db")))
+        return paths
+
+    def _remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
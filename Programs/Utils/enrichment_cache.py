@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+import pyarrow as pa
+from Utils.column_dependency import dependencies, vanilla_cols
+from Utils.column_writeback import write_column, add_column, commit_column, savepoint
+from Utils.db_snapshot import BUILD_TABLE
+from Utils.event_log_view import column_table
+
+# bump when the way the programs generate, check or write back columns changes, older entries are ignored
+ENRICHMENT_CACHE_VERSION = 2
+
+
+def program_fingerprint(program):
+    """Hash of everything in the program that shapes the generated code: the class, the read_write preamble and per predictor
+    the signature instructions, fields and demos (so an optimized or reloaded program gets its own entries)"""
+    sha = hashlib.sha256()
+    sha.update(f"{ENRICHMENT_CACHE_VERSION}:{type(program).__name__}".encode())
+    sha.update(getattr(program, "read_write", "").encode())
+    for name, predictor in program.named_predictors():
+        signature = predictor.signature
+        sha.update(name.encode())
+        sha.update(signature.instructions.encode())
+        sha.update(json.dumps({k: str(v.json_schema_extra) for k, v in signature.fields.items()}, sort_keys=True).encode())
+        sha.update(json.dumps([demo.toDict() if hasattr(demo, "toDict") else demo for demo in predictor.demos], sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def _hash_rows(conn, query, batch_size=50000):
+    sha = hashlib.sha256()
+    cur = conn.cursor()
+    cur.execute(query)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        sha.update(repr(rows).encode())
+    cur.close()
+    return sha.hexdigest()
+
+
+def _table_columns(conn):
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(event_log);")
+    columns = [info[1] for info in cur.fetchall()]
+    cur.close()
+    return columns
+
+
+def column_fingerprint(conn, column):
+    """Hash of the values of one event_log column in row order, None if the column does not exist"""
+    if column not in _table_columns(conn):
+        return None
+    return _hash_rows(conn, f'SELECT "{column}" FROM event_log ORDER BY idx;')
+
+
+class EnrichmentCache:
+    """Disk backed cache of validated enrichments: for an instruction, the generated code, the values of the new column (by idx) and its description.
+    Entries are keyed by the instruction, the program fingerprint and the fingerprint of the base event log, so a re-run of an evaluation
+    restores the column instead of calling GENERATE, EXTRACT and ANSWER and executing the code again.
+    Columns that were generated from other generated columns also record the fingerprints of those and are only restored if they still match.
+    Every entry is one Arrow IPC file in cache_dir (the values) with the rest in its schema metadata."""
+
+    def __init__(self, cache_dir="enrichment_cache"):
+        self.cache_dir = cache_dir
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def data_fingerprint(self, conn, conn_path):
+        """Hash of the columns of the event log itself (not the added ones).
+        Databases cloned from a DatabaseSnapshot carry its build key (the log file, its size and mtime, the cleaning version and build options),
+        the hash is computed once per database file and build key. Without a build key the log is hashed on every call"""
+        table_columns = _table_columns(conn)
+        base = [c for c in vanilla_cols if c in table_columns]
+        memo_key = None
+        try:
+            row = conn.execute(f"SELECT key FROM {BUILD_TABLE};").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if row is not None:
+            memo_key = (conn_path, tuple(base), row[0])
+            with self._lock:
+                if memo_key in self._fingerprints:
+                    return self._fingerprints[memo_key]
+        order = "ORDER BY idx" if "idx" in table_columns else ""
+        names = ", ".join(f'"{c}"' for c in base)
+        fingerprint = _hash_rows(conn, f"SELECT {names} FROM event_log {order};")
+        if memo_key is not None:
+            with self._lock:
+                self._fingerprints[memo_key] = fingerprint
+        return fingerprint
+
+    def key(self, instruction, program_hash, data_hash):
+        return hashlib.sha256("\n".join([instruction, program_hash, data_hash]).encode()).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".arrow")
+
+    def lookup(self, conn, key):
+        """The entry stored under key as (metadata dict, values DataFrame), None if there is none or the generated columns it was built from changed"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+            entry = json.loads(table.schema.metadata[b"entry"].decode())
+        except (pa.ArrowInvalid, KeyError, ValueError) as e:
+            print(f"ignoring unreadable enrichment cache entry {path}: {e}")
+            return None
+        for column, fingerprint in entry["dependencies"].items():
+            if column_fingerprint(conn, column) != fingerprint:
+                print(f"enrichment cache entry for {entry['column']} is stale, {column} changed")
+                return None
+        return entry, table.to_pandas()
+
+    def store(self, conn, key, instruction, column, python_code, description):
+        """Saves column as committed to event_log together with the code and description that produced it"""
+        table_name = column_table(conn, column)
+        if table_name is None:
+            return False
+        cur = conn.cursor()
+        cur.execute(f"PRAGMA table_info({table_name});")
+        sql_type = next((info[2] for info in cur.fetchall() if info[1] == column), None)
+        cur.close()
+        if sql_type is None:
+            return False
+        generated = [c for c in dependencies.get(column, []) if c not in vanilla_cols]
+        entry = {
+            "instruction": instruction,
+            "column": column,
+            "sql_type": sql_type,
+            "code": python_code,
+            "description": description,
+            "dependencies": {c: column_fingerprint(conn, c) for c in generated},
+        }
+        values = pd.read_sql_query(f'SELECT idx, "{column}" FROM event_log;', conn)
+        table = pa.Table.from_pandas(values, preserve_index=False)
+        table = table.replace_schema_metadata({b"entry": json.dumps(entry).encode()})
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        # a unique temporary name, concurrent enrichments may store at the same time
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+        return True
+
+
+def restore_column(conn, entry, values):
+    """Writes a cached column back into event_log the way the programs commit a generated one (narrow temp table, commit_column in a savepoint).
+    The caller holds the write lock. Returns the number of restored rows"""
+    start = time.perf_counter()
+    column = entry["column"]
+    temp_table = f"temp_table_{column}"
+    with savepoint(conn):
+        num_rows = write_column(conn, values, column, temp_table=temp_table)
+        add_column(conn, column, entry["sql_type"])
+        commit_column(conn, column, temp_table=temp_table)
+        conn.execute(f"DROP TABLE IF EXISTS {temp_table};")
+    print(f"restored {column} from the enrichment cache in {time.perf_counter() - start:.2f}s")
+    return num_rows
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def enrichment_cache_for(cache_dir="enrichment_cache"):
+    """One cache object per directory, shared by all program instances (and their deepcopies in the evaluation threads)"""
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = EnrichmentCache(cache_dir)
+        return _caches[cache_dir]
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import sqlite3
+import pyarrow as pa
+from Utils.xes_ingest import CLEANING_VERSION, CENT_COLUMNS, iter_inferred_batches, write_event_batches
+
+# sqlite declared type -> arrow type of the cached column
+ARROW_TYPES = {
+    "TEXT": pa.string(),
+    "INTEGER": pa.int64(),
+    "REAL": pa.float64(),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_file(xes_path, cache_dir):
+    # keyed by the content of the xes file and the version of the cleaning code
+    stem = os.path.basename(str(xes_path)).split(".")[0]
+    return os.path.join(cache_dir, f"{stem}_{file_hash(xes_path)[:16]}_v{CLEANING_VERSION}.arrow")
+
+
+def arrow_schema(schema):
+    # the sqlite types are kept in the metadata, so the cache can be written back to sqlite with the same layout
+    fields = [pa.field(name, ARROW_TYPES[sql_type]) for name, sql_type in schema]
+    metadata = {b"sql_types": ",".join(sql_type for _, sql_type in schema).encode()}
+    return pa.schema(fields, metadata=metadata)
+
+
+def sql_schema(table):
+    sql_types = table.schema.metadata[b"sql_types"].decode().split(",")
+    return list(zip(table.schema.names, sql_types))
+
+
+def _record_batch(batch, pa_schema):
+    columns = [
+        pa.array([row[i] for row in batch], type=pa.string()).cast(field.type)
+        if pa.types.is_timestamp(field.type)
+        else pa.array([row[i] for row in batch], type=field.type)
+        for i, field in enumerate(pa_schema)
+    ]
+    return pa.record_batch(columns, schema=pa_schema)
+
+
+def _cast_batch(batch, pa_schema):
+    # a batch written before the schema widened: missing columns are NULL (0 for the euro columns), types are cast like sqlite would convert them
+    columns = []
+    for field in pa_schema:
+        if field.name not in batch.schema.names:
+            fill = 0 if field.name in CENT_COLUMNS else None
+            columns.append(pa.array([fill] * batch.num_rows, type=field.type))
+            continue
+        column = batch.column(field.name)
+        if column.type == field.type:
+            columns.append(column)
+        elif pa.types.is_string(field.type):
+            # the attribute turned out to have mixed types: the strings of the values, as event_rows writes them once the column is TEXT
+            values = [None if v is None else v.isoformat(" ") if pa.types.is_timestamp(column.type) else str(v) for v in column.to_pylist()]
+            columns.append(pa.array(values, type=field.type))
+        else:
+            columns.append(column.cast(field.type))
+    return pa.record_batch(columns, schema=pa_schema)
+
+
+def build_cache(xes_path, path, batch_size=50000):
+    """Streams the xes file once and writes the cleaned event log as an uncompressed Arrow IPC file (memory mappable).
+    The schema is inferred while parsing (see xes_ingest.iter_inferred_batches): batches are written with the schema known so far, a batch that
+    widens it starts a new segment file. Only if there is more than one segment they are cast to the final schema, batch by batch"""
+    segments = []
+    sink = writer = None
+    try:
+        for schema, batch in iter_inferred_batches(xes_path, batch_size):
+            if not segments or segments[-1][1] != schema:
+                if writer is not None:
+                    writer.close()
+                    sink.close()
+                segment_path = f"{path}.part{len(segments)}"
+                sink = pa.OSFile(segment_path, "wb")
+                writer = pa.ipc.new_file(sink, arrow_schema(schema))
+                segments.append((segment_path, schema))
+            writer.write_batch(_record_batch(batch, arrow_schema(schema)))
+    finally:
+        if writer is not None:
+            writer.close()
+            sink.close()
+
+    tmp_path = path + ".tmp"
+    if len(segments) == 1:
+        os.replace(segments[0][0], tmp_path)
+    else:
+        pa_schema = arrow_schema(segments[-1][1] if segments else [])
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, pa_schema) as writer:
+            for segment_path, _ in segments:
+                with pa.memory_map(segment_path, "r") as source:
+                    reader = pa.ipc.open_file(source)
+                    for i in range(reader.num_record_batches):
+                        writer.write_batch(_cast_batch(reader.get_batch(i), pa_schema))
+                os.remove(segment_path)
+    # only a complete file is ever visible under the cache name
+    os.replace(tmp_path, path)
+
+
+def load_event_log(xes_path, cache_dir="event_log_cache", refresh=False):
+    """Returns the cleaned event log as a pyarrow Table. The first call parses the xes file and writes the cache,
+    later calls memory map the cache file and read it without copying. Set refresh=True to rebuild the cache."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_file(xes_path, cache_dir)
+    if refresh or not os.path.exists(path):
+        print(f"building event log cache {path}")
+        build_cache(xes_path, path)
+    source = pa.memory_map(path, "r")
+    return pa.ipc.open_file(source).read_all()
+
+
+def iter_table_rows(table, batch_size=50000):
+    # batches of row tuples as sqlite expects them (timestamps formatted like pandas.to_sql)
+    for batch in table.to_batches(max_chunksize=batch_size):
+        columns = []
+        for field, column in zip(batch.schema, batch.columns):
+            values = column.to_pylist()
+            if pa.types.is_timestamp(field.type):
+                values = [None if v is None else v.isoformat(" ") for v in values]
+            columns.append(values)
+        yield list(zip(*columns))
+
+
+def cache_to_sqlite(table, conn, table_name="event_log", batch_size=50000):
+    """Writes a cached event log (see load_event_log) into sqlite, replacing the table. Returns the number of inserted events"""
+    if isinstance(conn, str):
+        conn = sqlite3.connect(conn)
+    num_rows = write_event_batches(conn, sql_schema(table), iter_table_rows(table, batch_size), table_name)
+    print(f"loaded {num_rows} events into {table_name}")
+    return num_rows
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+import pyarrow as pa
+from Utils.event_log_view import virtual_columns
+
+
+def normalize_bools(dp, columns=None):
+    # the bool conversion of the read_write preamble: 0/1 columns become bool, except for counts
+    for cols in dp.columns if columns is None else columns:
+        if dp[cols].isin([0, 1]).all() and not cols.endswith("_count"):
+            dp[cols] = dp[cols].astype(bool)
+    return dp
+
+
+def read_event_log(conn, columns=None):
+    """What the read_write preamble reads: event_log with timestamps parsed and 0/1 columns as bool. columns=None reads all columns"""
+    if columns is None:
+        dp = pd.read_sql_query("SELECT * FROM event_log", conn, parse_dates=["time_timestamp"])
+        return normalize_bools(dp)
+    names = ", ".join(f'"{c}"' for c in columns)
+    parse_dates = ["time_timestamp"] if "time_timestamp" in columns else None
+    dp = pd.read_sql_query(f"SELECT {names} FROM event_log", conn, parse_dates=parse_dates)
+    return normalize_bools(dp)
+
+
+def _schema(conn):
+    cur = conn.cursor()
+    cur.execute("PRAGMA schema_version;")
+    version = cur.fetchone()[0]
+    cur.execute("PRAGMA table_info(event_log);")
+    columns = [info[1] for info in cur.fetchall()]
+    cur.close()
+    return version, columns
+
+
+class EventLogFrameCache:
+    """A warm, type normalized DataFrame of event_log for the column enricher, so generated code and every retry skip
+    the read_sql_query of the whole log. Columns are read on first use, a run that only needs a few columns only reads those.
+    The cache follows the schema of the database: columns added by the programs are appended (only that column is read),
+    columns that disappeared (dropped, database reset to the golden clone) are removed."""
+
+    def __init__(self, conn_path):
+        self.conn_path = conn_path
+        self.dp = None
+        self.schema_version = None
+        # columns the programs added after the log was read
+        self.added = set()
+        # bumped on every change of the cached frame, names the shared Arrow files
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def frame(self, conn=None, columns=None):
+        """A private copy of the cached frame for one run of generated code, restricted to columns (plus the idx row key) if given.
+        With pandas copy on write enabled this is a shallow copy, otherwise the column arrays are copied (the strings themselves are shared),
+        which is still far cheaper than reading the log"""
+        close = conn is None
+        if close:
+            conn = sqlite3.connect(self.conn_path)
+        try:
+            with self._lock:
+                wanted = self._prepare(conn, columns)
+                if wanted is None:
+                    # without the row key cached columns cannot be aligned
+                    return read_event_log(conn)
+                return self.dp[wanted].copy(deep=not pd.options.mode.copy_on_write)
+        finally:
+            if close:
+                conn.close()
+
+    def shared_frame(self, conn, columns, directory):
+        """Writes the frame(conn, columns) as an uncompressed Arrow IPC file to directory and returns its path, for worker processes to memory map.
+        The file is reused as long as the cache does not change, older files of this cache are removed"""
+        # one subdirectory per database file, the cleanup below never touches the files of another database (e.g. combined.db / combined_eval.db)
+        path_hash = hashlib.sha256(os.path.abspath(self.conn_path).encode()).hexdigest()[:8]
+        directory = os.path.join(directory, f"{os.path.basename(self.conn_path)}_{path_hash}")
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            wanted = self._prepare(conn, columns)
+            dp = read_event_log(conn) if wanted is None else self.dp[wanted]
+            key = f"{self.generation}_{abs(hash(tuple(dp.columns))):x}"
+            path = os.path.join(directory, key + ".arrow")
+            if not os.path.exists(path):
+                for name in os.listdir(directory):
+                    if not name.startswith(f"{self.generation}_"):
+                        os.remove(os.path.join(directory, name))
+                table = pa.Table.from_pandas(dp, preserve_index=False)
+                with pa.OSFile(path + ".tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+                os.replace(path + ".tmp", path)
+            return path
+
+    def append_column(self, conn, column):
+        """Adds a column the program just committed to event_log, read back the same way the preamble would read it"""
+        with self._lock:
+            if self.dp is None:
+                return
+            version, columns = _schema(conn)
+            # virtual columns of the view may be computed from the new values, they are read again on their next use
+            stale = [column] + list(virtual_columns(conn))
+            self.dp = self.dp.drop(columns=[c for c in stale if c in self.dp.columns])
+            self._load(conn, ["idx", column])
+            self.added.add(column)
+            self.generation += 1
+            # only our own ALTER TABLE happened since the last frame(), otherwise the next frame() catches up
+            if self.schema_version is not None and version == self.schema_version + 1:
+                self.schema_version = version
+            else:
+                self.schema_version = None
+
+    def drop_column(self, column):
+        with self._lock:
+            if self.dp is not None and column in self.dp.columns:
+                self.dp = self.dp.drop(columns=[column])
+                self.added.discard(column)
+                self.generation += 1
+
+    def invalidate(self):
+        with self._lock:
+            self.dp = None
+            self.schema_version = None
+            self.added = set()
+            self.generation += 1
+
+    def _prepare(self, conn, columns):
+        # brings the cache up to date and loads the wanted columns, None if event_log has no row key
+        version, table_columns = _schema(conn)
+        if "idx" not in table_columns:
+            return None
+        self._sync(version, table_columns)
+        wanted = [c for c in table_columns if columns is None or c in columns or c == "idx"]
+        self._load(conn, wanted)
+        return wanted
+
+    def _sync(self, version, table_columns):
+        if self.dp is None or version == self.schema_version:
+            self.schema_version = version
+            return
+        # the schema changed behind the cache (other threads, reset to the golden clone): the columns of the log itself never change,
+        # added columns may have been dropped and added again, so those are read again on their next use
+        self.dp = self.dp.drop(columns=[c for c in self.dp.columns if c not in table_columns or c in self.added])
+        self.added = set()
+        self.schema_version = version
+        self.generation += 1
+
+    def _load(self, conn, wanted):
+        missing = [c for c in wanted if self.dp is None or c not in self.dp.columns]
+        if not missing:
+            return
+        start = time.perf_counter()
+        if self.dp is None:
+            self.dp = read_event_log(conn, wanted)
+        else:
+            new = read_event_log(conn, ["idx"] + [c for c in missing if c != "idx"])
+            if len(new) != len(self.dp) or not (new["idx"].to_numpy() == self.dp["idx"].to_numpy()).all():
+                # the rows moved, start over with the wanted columns
+                self.dp = read_event_log(conn, wanted)
+                self.added = set()
+            else:
+                for c in new.columns:
+                    if c != "idx":
+                        self.dp[c] = new[c].to_numpy()
+        self.generation += 1
+        print(f"cached {len(missing)} event_log columns ({len(self.dp)} rows) in {time.perf_counter() - start:.2f}s")
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def frame_cache_for(conn_path):
+    """One cached frame per database file, shared by all program instances (and their deepcopies in the evaluation threads)"""
+    with _caches_lock:
+        if conn_path not in _caches:
+            _caches[conn_path] = EventLogFrameCache(conn_path)
+        return _caches[conn_path]
@@ -0,0 +1,66 @@
+import sqlite3
+
+# every table holding events is kept sorted by case and time, the sequence key follows this order
+CASE_ORDER = ["case_concept_name", "time_timestamp"]
+
+EVENT_LOG_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_case_concept_name ON event_log(case_concept_name);",
+    "CREATE INDEX IF NOT EXISTS idx_concept_name ON event_log(concept_name);",
+    "CREATE INDEX IF NOT EXISTS idx_timestamp ON event_log(time_timestamp);",
+]
+
+
+def table_columns(conn, table):
+    # [(name, declared type), ...]
+    cur = conn.cursor()
+    cur.execute(f'PRAGMA table_info("{table}");')
+    columns = [(info[1], info[2]) for info in cur.fetchall()]
+    cur.close()
+    return columns
+
+
+def build_ordered_table(conn, source, target=None, key="idx", tiebreak="rowid"):
+    """Writes source into target sorted by (case_concept_name, time_timestamp) and assigns the sequence key in the same pass.
+    The key becomes the INTEGER PRIMARY KEY (rowid alias), so the rows are stored clustered in case order and lookups by key need no extra index.
+    Ties on (case, timestamp) are broken by tiebreak, which keeps the original order of the source. source and target may be the same table."""
+    if target is None:
+        target = source
+    columns = [(name, col_type) for name, col_type in table_columns(conn, source) if name != key]
+    if not columns:
+        raise ValueError(f"table {source} does not exist or has no columns")
+    staging = f"{target}__ordered"
+    column_defs = ", ".join(f'"{name}" {col_type}'.rstrip() for name, col_type in columns)
+    column_names = ", ".join(f'"{name}"' for name, _ in columns)
+    order_by = ", ".join(f'"{col}"' for col in CASE_ORDER)
+    order_by += ", rowid" if tiebreak == "rowid" else f', "{tiebreak}"'
+
+    cur = conn.cursor()
+    cur.execute(f'DROP TABLE IF EXISTS "{staging}";')
+    cur.execute(f'CREATE TABLE "{staging}" ("{key}" INTEGER PRIMARY KEY, {column_defs});')
+    cur.execute(
+        f'INSERT INTO "{staging}" ("{key}", {column_names}) '
+        f'SELECT ROW_NUMBER() OVER (ORDER BY {order_by}), {column_names} FROM "{source}" ORDER BY {order_by};'
+    )
+    cur.execute(f'DROP TABLE "{source}";')
+    if target != source:
+        cur.execute(f'DROP TABLE IF EXISTS "{target}";')
+    cur.execute(f'ALTER TABLE "{staging}" RENAME TO "{target}";')
+    conn.commit()
+    cur.close()
+
+
+def setup_event_log(conn, indexes=EVENT_LOG_INDEXES, table="event_log"):
+    """Turns a freshly loaded event_log into the layout the programs expect: sorted by case and time with the idx sequence key, indexed and analyzed"""
+    if isinstance(conn, str):
+        conn = sqlite3.connect(conn)
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS temp_table;")
+    conn.commit()
+    build_ordered_table(conn, table, table, key="idx")
+    for index_query in indexes:
+        cur.execute(index_query)
+    conn.commit()
+    cur.execute("VACUUM;")
+    cur.execute("ANALYZE;")
+    conn.commit()
+    cur.close()
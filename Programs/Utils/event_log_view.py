@@ -0,0 +1,184 @@
+import sqlite3
+
+# in the view layouts the events live in this table and event_log is a view over it that keeps the original column names
+BASE_TABLE = "event_log_base"
+
+# optional table with one row per case for columns that hold the same value for every event of a case, joined into the event_log view
+CASE_TABLE = "case_attributes"
+CASE_KEY = "case_concept_name"
+
+# optional registry of virtual columns: cheap derived columns the event_log view computes from other columns when a query uses them, never stored
+VIRTUAL_TABLE = "virtual_columns"
+
+
+def is_view(conn, name="event_log"):
+    cur = conn.cursor()
+    cur.execute("SELECT type FROM sqlite_master WHERE name = ?;", (name,))
+    row = cur.fetchone()
+    cur.close()
+    return row is not None and row[0] == "view"
+
+
+def storage_table(conn):
+    # the table new event columns are added to and updated in
+    return BASE_TABLE if is_view(conn) else "event_log"
+
+
+def has_table(conn, name):
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,))
+    found = cur.fetchone() is not None
+    cur.close()
+    return found
+
+
+def new_column_table(conn):
+    # the table the generated code adds its new column to: the case table if there is one (the program moves columns that differ within a case to the events)
+    return CASE_TABLE if has_table(conn, CASE_TABLE) else storage_table(conn)
+
+
+def column_table(conn, column):
+    """The table that holds column of the event_log view (the case table or the events table), None if there is no such column"""
+    if has_table(conn, CASE_TABLE) and column in [name for name, _ in _columns(conn, CASE_TABLE)]:
+        return CASE_TABLE
+    table = storage_table(conn)
+    if column in [name for name, _ in _columns(conn, table)]:
+        return table
+    return None
+
+
+def virtual_columns(conn):
+    """name -> SQL expression of the virtual columns of the event_log view, in the order they were added"""
+    if not has_table(conn, VIRTUAL_TABLE):
+        return {}
+    cur = conn.cursor()
+    cur.execute(f"SELECT name, expression FROM {VIRTUAL_TABLE} ORDER BY rowid;")
+    columns = dict(cur.fetchall())
+    cur.close()
+    return columns
+
+
+def _columns(conn, table):
+    cur = conn.cursor()
+    cur.execute(f'PRAGMA table_info("{table}");')
+    columns = [(info[1], info[2]) for info in cur.fetchall()]
+    cur.close()
+    return columns
+
+
+def refresh_event_log_view(conn):
+    """(Re)creates the event_log view over the base table, so the SQL generator and the column enricher keep seeing one event_log with the
+    original column names. The columns of the case table are joined in by case.
+    Has to be called after the base table or the case table gained or lost a column."""
+    # inside a transaction (an enrichment savepoint, see column_writeback.savepoint) the caller commits
+    nested = conn.in_transaction
+    select = [f'b."{name}"' for name, _ in _columns(conn, BASE_TABLE)]
+    join = ""
+    if has_table(conn, CASE_TABLE):
+        # a LEFT JOIN on the primary key, sqlite leaves it out of queries that use none of the case columns (aggregates still do the lookups)
+        select.extend(f'c."{name}"' for name, _ in _columns(conn, CASE_TABLE) if name != CASE_KEY)
+        join = f'LEFT JOIN {CASE_TABLE} c ON c."{CASE_KEY}" = b."{CASE_KEY}"'
+    # expressions over the stored columns, sqlite only evaluates them for queries that select them
+    select.extend(f'({expression}) AS "{name}"' for name, expression in virtual_columns(conn).items())
+    cur = conn.cursor()
+    cur.execute("DROP VIEW IF EXISTS event_log;")
+    cur.execute(f"CREATE VIEW event_log AS SELECT {', '.join(select)} FROM {BASE_TABLE} b {join};")
+    if not nested:
+        conn.commit()
+    cur.close()
+
+
+def _make_view(conn):
+    # a plain event_log table becomes the base table of the view, the indexes move along with the renamed table
+    if not is_view(conn):
+        conn.execute(f"ALTER TABLE event_log RENAME TO {BASE_TABLE};")
+
+
+def register_virtual_column(conn, column, expression):
+    """Adds column to the event_log view as expression over other columns of the view (quoted names), a plain event_log table becomes the
+    base table of the view first. Virtual columns the expression uses are inlined, the view only refers to stored columns"""
+    for name, inlined in virtual_columns(conn).items():
+        expression = expression.replace(f'"{name}"', f"({inlined})")
+    nested = conn.in_transaction
+    _make_view(conn)
+    cur = conn.cursor()
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {VIRTUAL_TABLE} (name TEXT PRIMARY KEY, expression TEXT NOT NULL);")
+    cur.execute(f"INSERT INTO {VIRTUAL_TABLE} VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET expression = excluded.expression;", (column, expression))
+    if not nested:
+        conn.commit()
+    cur.close()
+    refresh_event_log_view(conn)
+    return expression
+
+
+def unregister_virtual_columns(conn, columns):
+    """Removes virtual columns from the event_log view (nothing is stored, nothing is rewritten)"""
+    nested = conn.in_transaction
+    cur = conn.cursor()
+    cur.executemany(f"DELETE FROM {VIRTUAL_TABLE} WHERE name = ?;", [(c,) for c in columns])
+    if not nested:
+        conn.commit()
+    cur.close()
+    refresh_event_log_view(conn)
+
+
+def drop_event_column(conn, column):
+    """Drops a column from the event log (from the case table if it lives there).
+    In the view layout the view is dropped first (sqlite refuses to drop columns a view uses) and recreated afterwards.
+    Virtual columns are only removed from the view, as are the virtual columns computed from a dropped column"""
+    virtual = virtual_columns(conn)
+    if column in virtual:
+        unregister_virtual_columns(conn, [column])
+        return
+    dependents = [name for name, expression in virtual.items() if f'"{column}"' in expression]
+    if dependents:
+        print(f"dropping {column} removes the virtual columns {', '.join(dependents)}")
+        unregister_virtual_columns(conn, dependents)
+    nested = conn.in_transaction
+    table = column_table(conn, column) or storage_table(conn)
+    cur = conn.cursor()
+    if table != "event_log":
+        cur.execute("DROP VIEW IF EXISTS event_log;")
+    # sqlite refuses to drop indexed columns (e.g. indexes of the index advisor)
+    for name, index_columns in index_definitions(conn, table):
+        if column in index_columns:
+            cur.execute(f'DROP INDEX IF EXISTS "{name}";')
+    cur.execute(f'ALTER TABLE {table} DROP COLUMN "{column}";')
+    if not nested:
+        conn.commit()
+    cur.close()
+    if table != "event_log":
+        refresh_event_log_view(conn)
+
+
+def index_definitions(conn, table):
+    """[(index name, [columns])] for the user created indexes of table"""
+    cur = conn.cursor()
+    cur.execute(f'PRAGMA index_list("{table}");')
+    names = [row[1] for row in cur.fetchall() if row[3] == "c"]
+    indexes = []
+    for name in names:
+        cur.execute(f'PRAGMA index_info("{name}");')
+        indexes.append((name, [row[2] for row in cur.fetchall()]))
+    cur.close()
+    return indexes
+
+
+def create_case_attributes(conn):
+    """Optional storage mode for columns that are the same for every event of a case: they go into the case table (one row per case, keyed by
+    case_concept_name) instead of every event row, and the event_log view joins them back, so prompts and generated SQL stay unchanged.
+    A plain event_log table becomes the base table of the view first. Call it after the event log is set up."""
+    if isinstance(conn, str):
+        conn = sqlite3.connect(conn)
+    _make_view(conn)
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {CASE_TABLE};")
+    cur.execute(f'CREATE TABLE {CASE_TABLE} ("{CASE_KEY}" TEXT PRIMARY KEY) WITHOUT ROWID;')
+    cur.execute(f'INSERT INTO {CASE_TABLE} SELECT DISTINCT "{CASE_KEY}" FROM {BASE_TABLE} WHERE "{CASE_KEY}" IS NOT NULL;')
+    conn.commit()
+    cur.close()
+    refresh_event_log_view(conn)
+    cur = conn.cursor()
+    cur.execute("ANALYZE;")
+    conn.commit()
+    cur.close()
@@ -0,0 +1,237 @@
+import ast
+import re
+from Utils.column_dependency import dependencies
+from Utils.event_log_table import CASE_ORDER
+
+
+def _is_temp_table_write(node, temp_table):
+    # dp.to_sql('temp_table', conn, ...) as a statement of its own
+    if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)):
+        return False
+    call = node.value
+    if not (isinstance(call.func, ast.Attribute) and call.func.attr == "to_sql"):
+        return False
+    name = call.args[0] if call.args else next((kw.value for kw in call.keywords if kw.arg == "name"), None)
+    return isinstance(name, ast.Constant) and name.value == temp_table
+
+
+def _is_event_log_read(node, assignments):
+    # dp = pd.read_sql_query('SELECT * FROM event_log', conn, parse_dates=['time_timestamp']), the query inline or assigned to a variable before
+    if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id == "dp"):
+        return False
+    call = node.value
+    if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr in ("read_sql_query", "read_sql") and call.args):
+        return False
+    query = call.args[0]
+    if isinstance(query, ast.Name):
+        query = assignments.get(query.id)
+    if not (isinstance(query, ast.Constant) and isinstance(query.value, str)):
+        return False
+    if " ".join(query.value.replace(";", " ").split()).upper() != "SELECT * FROM EVENT_LOG":
+        return False
+    parse_dates = next((kw.value for kw in call.keywords if kw.arg == "parse_dates"), None)
+    return isinstance(parse_dates, ast.List) and [getattr(e, "value", None) for e in parse_dates.elts] == ["time_timestamp"]
+
+
+def _is_bool_conversion(node):
+    # for cols in dp.columns: if dp[cols].isin([0,1]).all() and not cols.endswith("_count"): dp[cols] = dp[cols].astype(bool)
+    if not (isinstance(node, ast.For) and isinstance(node.iter, ast.Attribute) and node.iter.attr == "columns"):
+        return False
+    if not (isinstance(node.iter.value, ast.Name) and node.iter.value.id == "dp"):
+        return False
+    source = ast.unparse(node)
+    return "isin([0, 1])" in source and "astype(bool)" in source and "_count" in source and not node.orelse
+
+
+def _blank_statements(python_code, nodes):
+    # every statement is replaced by "pass" on its first line and empty lines after it, so the line numbers in tracebacks stay the same
+    lines = python_code.split("\n")
+    for node in nodes:
+        first, last = node.lineno - 1, node.end_lineno - 1
+        indent = lines[first][: len(lines[first]) - len(lines[first].lstrip())]
+        lines[first] = indent + "pass"
+        for i in range(first + 1, last + 1):
+            lines[i] = ""
+    return "\n".join(lines)
+
+
+def strip_temp_table_write(python_code, temp_table="temp_table"):
+    """Removes the dp.to_sql('temp_table', ...) the read_write preamble asks the generated code for. It writes all columns of the event log,
+    the program writes back only the new column afterwards (see column_writeback.py). Code that does not parse is returned unchanged, exec reports the error"""
+    try:
+        tree = ast.parse(python_code)
+    except SyntaxError:
+        return python_code
+    nodes = [node for node in ast.walk(tree) if _is_temp_table_write(node, temp_table)]
+    if not nodes:
+        return python_code
+    return _blank_statements(python_code, nodes)
+
+
+# any spelling of the statement: case, whitespace, quoted names, multi word types (DOUBLE PRECISION, VARCHAR(20), ... DEFAULT 0)
+ADD_COLUMN_PATTERN = re.compile(r'^\s*ALTER\s+TABLE\s+["`\[]?event_log["`\]]?\s+ADD\s+(?:COLUMN\s+)?["`\[]?(?P<column>\w+)["`\]]?\s*(?P<type>[^;]*?)\s*;?\s*$',
+                                re.IGNORECASE)
+
+
+def strip_add_column(python_code, column):
+    """Removes the cur.execute("ALTER TABLE event_log ADD COLUMN ...") statements of the generated code. The program adds the new column itself
+    once the values passed the checks (see column_writeback.add_column), in the table behind the event_log view if there is one, so attempts
+    that fail never change the schema. Other columns the code adds are never written back and are removed as well.
+    Returns (code, declared type of column). The type is None if the code does not add column, the program then adds it with the type the
+    model declared"""
+    try:
+        tree = ast.parse(python_code)
+    except SyntaxError:
+        return python_code, None
+    nodes = []
+    declared_type = None
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Attribute)):
+            continue
+        call = node.value
+        if call.func.attr != "execute" or not call.args or not isinstance(call.args[0], ast.Constant) or not isinstance(call.args[0].value, str):
+            continue
+        match = ADD_COLUMN_PATTERN.match(call.args[0].value)
+        if match:
+            nodes.append(node)
+            # sqlite column names are case insensitive
+            if match.group("column").lower() == column.lower() and declared_type is None:
+                declared_type = match.group("type")
+    if not nodes:
+        return python_code, None
+    return _blank_statements(python_code, nodes), declared_type
+
+
+def strip_event_log_read(python_code):
+    """Removes the read head of the read_write preamble (read_sql_query of the whole event_log followed by the bool conversion loop),
+    so the program can hand the generated code a cached, already converted dp (see event_log_frame.py).
+    Returns (code, stripped). Only the exact preamble is removed, code that reads differently is returned unchanged and reads as before"""
+    try:
+        tree = ast.parse(python_code)
+    except SyntaxError:
+        return python_code, False
+    assignments = {}
+    for i, node in enumerate(tree.body):
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            if _is_event_log_read(node, assignments):
+                following = tree.body[i + 1] if i + 1 < len(tree.body) else None
+                if following is None or not _is_bool_conversion(following):
+                    return python_code, False
+                return _blank_statements(python_code, [node, following]), True
+            assignments[node.targets[0].id] = node.value
+        elif any(isinstance(n, ast.Name) and n.id == "dp" for n in ast.walk(node)):
+            # dp is used before it was read, leave the code alone
+            return python_code, False
+    return python_code, False
+
+
+# methods of the full frame whose result for the used columns does not depend on the other columns
+FRAME_METHODS = {
+    "groupby", "merge", "join", "sort_values", "sort_index", "assign", "copy", "reset_index", "set_index", "drop", "rename", "apply",
+    "query", "eval", "fillna", "astype", "head", "tail", "sample", "where", "mask", "replace", "isin", "pivot_table",
+    "drop_duplicates", "duplicated", "dropna",
+}
+# methods that return a frame with (at least) the rows of the full frame, the result is tracked like dp itself
+FRAME_RETURNING = FRAME_METHODS - {"groupby", "apply", "eval", "isin", "pivot_table", "duplicated"}
+# frame wide methods that only stay column local with an explicit subset
+SUBSET_METHODS = {"drop_duplicates", "duplicated", "dropna"}
+MERGE_KEYS = {"on", "left_on", "right_on", "left_index", "right_index"}
+SAFE_FUNCTIONS = {"len", "print", "isinstance"}
+
+
+def _is_frame(node, frames):
+    # whether node evaluates to dp or a frame derived from it that still has all of its columns
+    if isinstance(node, ast.Name):
+        return node.id in frames
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        if node.func.attr in FRAME_RETURNING and _is_frame(node.func.value, frames):
+            return True
+        if node.func.attr in ("merge", "concat") and any(_is_frame(arg, frames) for arg in node.args):
+            return True
+        if isinstance(node.func.value, ast.Name) and node.func.value.id == "pd" and node.func.attr == "concat":
+            return any(isinstance(arg, ast.List) and any(_is_frame(e, frames) for e in arg.elts) for arg in node.args)
+    if isinstance(node, ast.Subscript):
+        # dp[mask] and dp.loc[mask] keep all columns, dp['col'], dp[['a', 'b']] and dp.loc[mask, 'col'] do not
+        value = node.value
+        if isinstance(value, ast.Attribute) and value.attr in ("loc", "iloc"):
+            return _is_frame(value.value, frames) and not isinstance(node.slice, ast.Tuple)
+        if _is_frame(value, frames):
+            return not (isinstance(node.slice, (ast.Constant, ast.List)))
+    return False
+
+
+def _merge_without_keys(call):
+    return not any(kw.arg in MERGE_KEYS for kw in call.keywords)
+
+
+def referenced_columns(python_code, table_columns):
+    """The event_log columns the generated code can touch, found statically: column names in string literals (also inside query strings)
+    and attribute accesses. Returns None if the code uses dp in a way that may depend on columns it does not name
+    (dp.columns, frame wide methods, iterating over the frame, passing it to unknown functions), then the whole table has to be loaded"""
+    try:
+        tree = ast.parse(python_code)
+    except SyntaxError:
+        return None
+
+    # dp and every name assigned a frame that still has all columns of dp
+    frames = {"dp"}
+    changed = True
+    while changed:
+        changed = False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Assign) and _is_frame(node.value, frames):
+                for target in node.targets:
+                    if isinstance(target, ast.Name) and target.id not in frames:
+                        frames.add(target.id)
+                        changed = True
+
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+
+    table = set(table_columns)
+    columns = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            columns.update(token for token in re.findall(r"\w+", node.value) if token in table)
+        elif isinstance(node, ast.Attribute):
+            if node.attr in table:
+                columns.add(node.attr)
+            if not _is_frame(node.value, frames):
+                continue
+            parent = parents.get(node)
+            if node.attr in ("loc", "iloc", "at", "iat", "index", "shape", "empty") or node.attr in table:
+                continue
+            if not (isinstance(parent, ast.Call) and parent.func is node and node.attr in FRAME_METHODS):
+                return None
+            if node.attr in SUBSET_METHODS and not any(kw.arg == "subset" for kw in parent.keywords):
+                return None
+            if node.attr in ("merge", "join") and _merge_without_keys(parent):
+                return None
+        elif isinstance(node, ast.For) and _is_frame(node.iter, frames):
+            return None
+        elif isinstance(node, ast.Call) and any(_is_frame(arg, frames) for arg in node.args):
+            func = node.func
+            if isinstance(func, ast.Name) and func.id in SAFE_FUNCTIONS:
+                continue
+            if isinstance(func, ast.Attribute) and func.attr == "merge" and not _merge_without_keys(node):
+                continue
+            if isinstance(func, ast.Attribute) and func.attr == "concat":
+                continue
+            return None
+    return columns
+
+
+def columns_to_load(python_code, table_columns, new_column):
+    """Columns the generated code for new_column gets in dp: the referenced columns, cross-checked with the dependencies of new_column
+    in the dependency graph (dependencies are always loaded), plus the row key and the case order columns the write back may need.
+    None means all columns"""
+    columns = referenced_columns(python_code, table_columns)
+    if columns is None:
+        return None
+    expected = [c for c in dependencies.get(new_column, []) if c in table_columns]
+    not_referenced = [c for c in expected if c not in columns]
+    if not_referenced:
+        print(f"generated code for {new_column} does not reference its dependencies {not_referenced}, loading them anyway")
+    return columns | set(expected) | {"idx"} | set(CASE_ORDER)
@@ -0,0 +1,247 @@
+import re
+import sqlite3
+import statistics
+from Utils.column_writeback import write_lock_for
+from Utils.event_log_view import CASE_TABLE, CASE_KEY, index_definitions, storage_table, has_table
+from Utils.query_execution import run_query
+from Utils.query_plan import query_plan
+
+# indexes created by the advisor, the only ones it ever drops
+INDEX_PREFIX = "auto_idx_"
+MAX_INDEX_COLUMNS = 4
+
+# column <op> ...: equality predicates lead a composite index, at most one range predicate follows them
+PREDICATE_PATTERN = re.compile(r'(?:\b\w+\.)?"?(\w+)"?\s*(==|=|<=|>=|<|>|\bIN\b|\bIS\b|\bBETWEEN\b|\bLIKE\b)', re.IGNORECASE)
+# ... = column: the other side of join conditions
+JOINED_PATTERN = re.compile(r'=\s*(?:\w+\.)?"?(\w+)"?', re.IGNORECASE)
+GROUP_BY_PATTERN = re.compile(r"\bGROUP\s+BY\s+(.*?)(?=\bHAVING\b|\bORDER\b|\bLIMIT\b|\bUNION\b|\bWINDOW\b|\)|;|$)", re.IGNORECASE | re.DOTALL)
+AGGREGATE_PATTERN = re.compile(r'\b(?:SUM|AVG|MIN|MAX|COUNT|TOTAL)\s*\(\s*(?:DISTINCT\s+)?(?:\w+\.)?"?(\w+)"?', re.IGNORECASE)
+STRING_PATTERN = re.compile(r"'(?:[^']|'')*'")
+EQUALITY_OPERATORS = ("=", "==", "in", "is")
+
+
+class IndexAdvice:
+    """A proposed index: the table, its columns (composite, covering the aggregated columns of group bys) and the queries of the workload it
+    was derived from"""
+
+    def __init__(self, table, columns, kind):
+        self.table = table
+        self.columns = tuple(columns)
+        # "filter" (equality and range predicates, join keys) or "group" (group by, plus aggregated columns to cover the query)
+        self.kind = kind
+        self.queries = []
+
+    @property
+    def name(self):
+        return INDEX_PREFIX + "_".join((self.table,) + self.columns)
+
+    def sql(self):
+        columns = ", ".join(f'"{c}"' for c in self.columns)
+        return f'CREATE INDEX IF NOT EXISTS "{self.name}" ON "{self.table}"({columns});'
+
+    def __repr__(self):
+        return f"IndexAdvice({self.table}({', '.join(self.columns)}), {self.kind}, {len(self.queries)} queries)"
+
+
+def _fresh_plan(conn, query):
+    # the advisor looks at plans right after indexes changed, possibly on another connection. EXPLAIN never reads the database, so neither is
+    # the schema reloaded nor a cached statement prepared again: a read reloads the schema, the schema version in the text keeps cached plans
+    # of older schemas out (the plan check of the programs runs once per query and does without)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT 1 FROM sqlite_master LIMIT 1;")
+        cur.fetchall()
+        cur.execute("PRAGMA schema_version;")
+        version = cur.fetchone()[0]
+    finally:
+        cur.close()
+    return query_plan(conn, f"{query.strip().rstrip(';')}\n-- schema {version}")
+
+
+def workload(*programs):
+    """The generated queries recorded by SQL programs (their queries attribute, question -> queries), in the order they were generated"""
+    queries = []
+    for program in programs:
+        for question_queries in program.queries.values():
+            queries.extend(question_queries)
+    return queries
+
+
+def _unique(names):
+    return list(dict.fromkeys(names))
+
+
+def _indexable_columns(conn):
+    # column -> stored table for the event table and the case table, virtual columns are computed by the view and cannot be indexed
+    tables = [storage_table(conn)] + ([CASE_TABLE] if has_table(conn, CASE_TABLE) else [])
+    columns = {}
+    for table in tables:
+        cur = conn.cursor()
+        cur.execute(f'PRAGMA table_info("{table}");')
+        for info in cur.fetchall():
+            # idx is the rowid, the key of the case table is its primary key
+            if info[1] not in ("idx", CASE_KEY if table == CASE_TABLE else None):
+                columns.setdefault(info[1], table)
+        cur.close()
+    return columns
+
+
+def _candidates(query, columns):
+    """(table, columns, kind) index candidates of one query, from its predicates, join conditions, group bys and aggregates"""
+    text = STRING_PATTERN.sub("''", query)
+    equality, ranges = [], []
+    for name, op in PREDICATE_PATTERN.findall(text):
+        if name not in columns:
+            continue
+        (equality if op.lower() in EQUALITY_OPERATORS else ranges).append(name)
+    equality.extend(name for name in JOINED_PATTERN.findall(text) if name in columns)
+    group_by = [name for clause in GROUP_BY_PATTERN.findall(text) for name in re.findall(r'"?(\w+)"?', clause) if name in columns]
+    aggregated = [name for name in AGGREGATE_PATTERN.findall(text) if name in columns]
+
+    candidates = []
+    for table in _unique(columns[name] for name in equality + ranges + group_by):
+        equal = _unique(name for name in equality if columns[name] == table)
+        ranged = [name for name in _unique(ranges) if columns[name] == table and name not in equal][:1]
+        if equal or ranged:
+            candidates.append((table, tuple((equal + ranged)[:MAX_INDEX_COLUMNS]), "filter"))
+        grouped = _unique(name for name in group_by if columns[name] == table)
+        if grouped:
+            covered = _unique(grouped + [name for name in aggregated if columns[name] == table])
+            candidates.append((table, tuple(covered[:MAX_INDEX_COLUMNS]), "group"))
+    return candidates
+
+
+def _covered(conn, table, columns):
+    # an existing index starting with the same columns serves the same lookups
+    return any(tuple(index_columns[: len(columns)]) == tuple(columns) for _, index_columns in index_definitions(conn, table))
+
+
+def mine_workload(conn, queries, min_queries=2):
+    """The IndexAdvice for composite keys the workload filters, joins or groups on at least min_queries times and no existing index covers,
+    most frequent first. Queries whose plan already searches an index on the leading column do not count"""
+    columns = _indexable_columns(conn)
+    advice = {}
+    for query in _unique(queries):
+        try:
+            details = [detail for _, _, detail in _fresh_plan(conn, query)]
+        except sqlite3.Error:
+            continue
+        for table, candidate, kind in _candidates(query, columns):
+            if not candidate or _covered(conn, table, candidate):
+                continue
+            # the plan already searches an index on the leading column: nothing to gain
+            if any(detail.startswith("SEARCH") and f"({candidate[0]}=" in detail for detail in details):
+                continue
+            key = (table, candidate)
+            if key not in advice:
+                advice[key] = IndexAdvice(table, candidate, kind)
+            advice[key].queries.append(query)
+    proposals = [a for a in advice.values() if len(a.queries) >= min_queries]
+    return sorted(proposals, key=lambda a: len(a.queries), reverse=True)
+
+
+def _median_seconds(conn, queries, repeat, timeout):
+    seconds = []
+    for query in queries:
+        stats = []
+        for _ in range(repeat):
+            try:
+                run_query(conn, query, timeout=timeout, stats=stats)
+            except Exception:
+                break
+        if stats:
+            seconds.append(statistics.median(record["seconds"] for record in stats))
+    return sum(seconds)
+
+
+def _uses(conn, queries, name):
+    for query in queries:
+        try:
+            if any(f"INDEX {name}" in detail for _, _, detail in _fresh_plan(conn, query)):
+                return True
+        except sqlite3.Error:
+            pass
+    return False
+
+
+def _in_snapshot(snapshot, advice):
+    # sqlite takes an unknown "column" for a string and would index the constant, so the columns are checked against the golden database
+    conn = sqlite3.connect(f"file:{snapshot.golden_path}?mode=ro", uri=True)
+    try:
+        columns = _indexable_columns(conn)
+    finally:
+        conn.close()
+    return all(columns.get(name) == advice.table for name in advice.columns)
+
+
+def advise_indexes(conn_path, queries, create=False, min_queries=2, min_speedup=1.2, sample=5, repeat=3, timeout=60, snapshot=None):
+    """Mines queries (e.g. workload(sql_program)) for indexes and reports them. With create=True every proposal is built and measured on up to
+    sample of its queries: it is kept if the plans use it and the queries run at least min_speedup times faster, otherwise it is dropped again.
+    Resetting conn_path to its DatabaseSnapshot removes the kept indexes, with snapshot they are built in the golden database as well
+    (indexes on enriched columns, which the golden database does not have, are left out).
+    Returns one dict per proposal (index, queries, kept, in_snapshot, seconds before and after)"""
+    conn = sqlite3.connect(conn_path)
+    report = []
+    try:
+        for advice in mine_workload(conn, queries, min_queries):
+            entry = {"index": advice.sql(), "kind": advice.kind, "queries": len(advice.queries), "kept": None, "in_snapshot": False, "before": None, "after": None}
+            report.append(entry)
+            if not create:
+                print(f"proposed {advice.sql()} for {len(advice.queries)} queries")
+                continue
+            measured = advice.queries[:sample]
+            before = _median_seconds(conn, measured, repeat, timeout)
+            with write_lock_for(conn_path):
+                conn.execute(advice.sql())
+                conn.execute(f'ANALYZE "{advice.name}";')
+                conn.commit()
+            after = _median_seconds(conn, measured, repeat, timeout)
+            kept = _uses(conn, measured, advice.name) and after * min_speedup <= before
+            if not kept:
+                with write_lock_for(conn_path):
+                    conn.execute(f'DROP INDEX IF EXISTS "{advice.name}";')
+                    conn.commit()
+            entry.update(kept=kept, before=before, after=after)
+            print(f"{'kept' if kept else 'dropped'} {advice.name}: {len(measured)} queries {before:.3f}s -> {after:.3f}s")
+            if kept and snapshot is not None:
+                if _in_snapshot(snapshot, advice):
+                    snapshot.apply([advice.sql(), f'ANALYZE "{advice.name}";'])
+                    entry["in_snapshot"] = True
+                else:
+                    print(f"{advice.name} not added to {snapshot.golden_path}, it indexes enriched columns")
+    finally:
+        conn.close()
+    return report
+
+
+def unused_indexes(conn, queries):
+    """The indexes of the advisor that no plan of the workload uses"""
+    tables = [storage_table(conn)] + ([CASE_TABLE] if has_table(conn, CASE_TABLE) else [])
+    created = [name for table in tables for name, _ in index_definitions(conn, table) if name.startswith(INDEX_PREFIX)]
+    used = set()
+    for query in _unique(queries):
+        try:
+            details = [detail for _, _, detail in _fresh_plan(conn, query)]
+        except sqlite3.Error:
+            continue
+        used.update(name for name in created if any(f"INDEX {name}" in detail for detail in details))
+    return [name for name in created if name not in used]
+
+
+def drop_unused_indexes(conn_path, queries, snapshot=None):
+    """Drops the indexes of the advisor that the workload never uses (the indexes of the log itself are left alone), with snapshot from its golden
+    database as well. Returns their names"""
+    conn = sqlite3.connect(conn_path)
+    try:
+        unused = unused_indexes(conn, queries)
+        if unused:
+            with write_lock_for(conn_path):
+                for name in unused:
+                    conn.execute(f'DROP INDEX IF EXISTS "{name}";')
+                conn.commit()
+            if snapshot is not None:
+                snapshot.apply([f'DROP INDEX IF EXISTS "{name}";' for name in unused])
+            print(f"dropped unused indexes {', '.join(unused)}")
+        return unused
+    finally:
+        conn.close()
@@ -0,0 +1,72 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# per call state of the PY programs, after a generation the program holds the values of its last instruction like after sequential calls
+_CALL_STATE = ("column_description", "commit_to_db")
+
+
+def _with_overrides(overrides, function, *args):
+    # same isolation as dspy's ParallelExecutor: every thread starts from the dspy settings (lm, backtracking state) of the caller
+    from dsp.utils.settings import thread_local_overrides
+    original_overrides = thread_local_overrides.overrides
+    thread_local_overrides.overrides = overrides
+    try:
+        return function(*args)
+    finally:
+        thread_local_overrides.overrides = original_overrides
+
+
+def _worker_copy(pm_py):
+    # __deepcopy__ of the programs leaves out the rm (shared again) and reconnects conn, the copy opens its own connections per call
+    worker = pm_py.deepcopy()
+    if getattr(worker, "conn", None) is not None:
+        worker.conn.close()
+        worker.conn = None
+    return worker
+
+
+def _merge(pm_py, worker):
+    # the history a worker added (code, errors, descriptions, exec stats per instruction) goes back into the program
+    for name, value in worker.__dict__.items():
+        original = getattr(pm_py, name, None)
+        if isinstance(value, defaultdict) and value.default_factory is list and isinstance(original, defaultdict):
+            for key, entries in value.items():
+                original[key].extend(entries[len(original.get(key, [])):])
+    for name in _CALL_STATE:
+        if name in worker.__dict__:
+            setattr(pm_py, name, getattr(worker, name))
+
+
+def run_generation(pm_py, instructions, max_workers=4):
+    """Runs the enrichments of one DependencyGraph generation concurrently, LLM calls and execution alike. The writes to the database are
+    serialized inside the PY programs (write_lock_for). Every thread runs its own deep copy of pm_py with its own dspy trace, so per call
+    state and backtracking (which goes back to the last predictor of the trace) never mix; their history and traces are merged back in the
+    order of instructions. Returns the results in that order; if an enrichment raised (e.g. a failed dspy.Suggest during backtracking),
+    the first error is raised once all of them finished"""
+    if len(instructions) <= 1:
+        return [pm_py(instruction) for instruction in instructions]
+    import dspy
+    from dsp.utils.settings import thread_local_overrides
+    parent_overrides = thread_local_overrides.overrides.copy()
+    parent_trace = dspy.settings.trace
+    workers = [_worker_copy(pm_py) for _ in instructions]
+    traces = [None if parent_trace is None else list(parent_trace) for _ in instructions]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(instructions))) as executor:
+        futures = [
+            executor.submit(_with_overrides, {**parent_overrides, "trace": trace}, worker, instruction)
+            for worker, trace, instruction in zip(workers, traces, instructions)
+        ]
+    start = 0 if parent_trace is None else len(parent_trace)
+    for worker, trace in zip(workers, traces):
+        _merge(pm_py, worker)
+        if parent_trace is not None:
+            # steps of the copied predictors are recorded for the predictors of pm_py (e.g. for bootstrapping demos)
+            predictors = {id(copied): original for (_, copied), (_, original) in zip(worker.named_predictors(), pm_py.named_predictors())}
+            parent_trace.extend((predictors.get(id(predictor), predictor), inputs, outputs) for predictor, inputs, outputs in trace[start:])
+    results = []
+    for future in futures:
+        error = future.exception()
+        if error is not None:
+            raise error
+        results.append(future.result())
+    return results
@@ -0,0 +1,118 @@
+import sqlite3
+import time
+from Utils.result_table import render_result, count_rows
+from Utils.query_plan import check_plan
+
+# the time limit of one generated query (execution, fetching the result table and counting its rows)
+QUERY_TIMEOUT = 60 * 5
+
+# sqlite virtual machine instructions between two deadline checks
+CHECK_EVERY = 1000
+
+
+class QueryTimeout(Exception):
+    """A generated query that ran into the time limit, sqlite stopped it. str() is the feedback for the query generator"""
+
+    def __init__(self, query, timeout, seconds):
+        super().__init__(f"Query execution exceeded the time limit of {timeout} seconds and was stopped. Use a query that executes faster.")
+        self.query = query
+        self.timeout = timeout
+        self.seconds = seconds
+
+
+class QueryRejected(Exception):
+    """A generated query whose plan would nest full scans of the event log (see query_plan.check_plan), it was not executed.
+    str() is the feedback for the query generator"""
+
+    def __init__(self, query, plan_check):
+        super().__init__(plan_check.feedback())
+        self.query = query
+        self.problems = plan_check.problems
+
+
+class QueryResult:
+    """The result table of a query (see result_table.render_result), the number of rows it shows and the total number of rows of the query
+    (None if it was cut off and not counted, see run_query)"""
+
+    def __init__(self, table, shown_rows, total_rows):
+        self.table = table
+        self.shown_rows = shown_rows
+        self.total_rows = total_rows
+
+
+class _Deadline:
+    # progress handler of one query: sqlite calls it every CHECK_EVERY instructions and stops the statement once it returns non zero
+    def __init__(self, timeout):
+        self.expires = time.monotonic() + timeout
+        self.expired = False
+
+    def __call__(self):
+        if time.monotonic() >= self.expires:
+            self.expired = True
+            return 1
+        return 0
+
+
+def run_query(conn, query, max_length=1500, timeout=QUERY_TIMEOUT, stats=None, cache=None, check=False, count_total=False):
+    """Executes query on conn, the pool connection the caller already holds, with a deadline instead of a watcher thread and a second connection:
+    a progress handler makes sqlite stop the statement after timeout seconds, raised as QueryTimeout. Other errors of sqlite are raised unchanged.
+    Returns the QueryResult. If stats is a list, a dict with the wall and cpu seconds of the query (this thread, sqlite runs in it), whether it
+    timed out and its total rows is appended to it, also for failed queries.
+    With a cache (see result_cache.ResultCache) the result of a query that already ran on the same version of the database is returned without
+    executing it. With check=True the plan of the query is checked first, queries with nested full scans of the event log are raised as
+    QueryRejected instead of running into the timeout.
+    The total rows of a result the table cut off are only counted with count_total=True, counting runs the query a second time"""
+    record = {"seconds": None, "cpu_seconds": None, "timed_out": False, "rows": None, "cached": False, "rejected": False, "plan_warnings": []}
+    key = cache.key(query, max_length) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    # a cached result that was cut off without counting is executed again if the count is asked for
+    if cached is not None and (cached.total_rows is not None or not count_total):
+        record.update(seconds=0.0, cpu_seconds=0.0, rows=cached.total_rows, cached=True)
+        if stats is not None:
+            stats.append(record)
+        return cached
+    deadline = _Deadline(timeout)
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    if check:
+        try:
+            plan = check_plan(conn, query)
+        except sqlite3.Error:
+            # the same error comes from executing it, with the usual stats
+            plan = None
+        if plan is not None and plan.problems:
+            record.update(seconds=time.perf_counter() - start, cpu_seconds=time.thread_time() - cpu_start, rejected=True)
+            if stats is not None:
+                stats.append(record)
+            raise QueryRejected(query, plan)
+        if plan is not None and plan.warnings:
+            record["plan_warnings"] = plan.warnings
+            print("query plan: " + "; ".join(plan.warnings))
+    conn.set_progress_handler(deadline, CHECK_EVERY)
+    cur = conn.cursor()
+    try:
+        cur.execute(query)
+        # only the rows that fit into max_length are fetched, closing the cursor stops the statement
+        table, shown_rows, complete = render_result(cur, max_length)
+        cur.close()
+        # the total number of rows of a cut off result is counted by sqlite if asked for, without fetching them (under the same deadline)
+        total_rows = shown_rows if complete else count_rows(conn, query) if count_total else None
+        record["rows"] = total_rows
+        result = QueryResult(table, shown_rows, total_rows)
+        if cache is not None:
+            cache.put(key, result)
+        return result
+    except sqlite3.OperationalError as e:
+        if deadline.expired:
+            record["timed_out"] = True
+            raise QueryTimeout(query, timeout, time.perf_counter() - start) from e
+        raise
+    finally:
+        cur.close()
+        conn.set_progress_handler(None, 0)
+        if conn.in_transaction:
+            # a query that wrote something is not committed by a pooled connection, a stopped one leaves its transaction open
+            conn.rollback()
+        record["seconds"] = time.perf_counter() - start
+        record["cpu_seconds"] = time.thread_time() - cpu_start
+        if stats is not None:
+            stats.append(record)
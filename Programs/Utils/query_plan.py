@@ -0,0 +1,84 @@
+import re
+from Utils.event_log_view import BASE_TABLE, is_view
+
+# FROM event_log e / JOIN event_log AS e / , event_log e: the plan names scans by their alias. Keywords after event_log are captured as well,
+# no scan is ever named after them
+EVENT_ALIAS_PATTERN = re.compile(r'(?:\bFROM|\bJOIN|,)\s*"?event_log"?(?:\s+AS)?\s+"?(\w+)"?', re.IGNORECASE)
+# alias of the base table in the event_log view (see event_log_view.refresh_event_log_view)
+VIEW_BASE_ALIAS = "b"
+
+SCAN_PATTERN = re.compile(r"^SCAN (\w+)")
+LOOP_PREFIXES = ("SCAN ", "SEARCH ")
+
+
+class PlanCheck:
+    """What EXPLAIN QUERY PLAN shows about a query: problems (full scans of the events nested in another one, every row of one scan runs the
+    other) reject the query, warnings (temp b-tree sorts over a full scan of the events) are only reported"""
+
+    def __init__(self, problems, warnings):
+        self.problems = problems
+        self.warnings = warnings
+
+    def feedback(self):
+        return (
+            "The query was not executed, its plan shows " + "; ".join(self.problems) + ". "
+            "Every row of the outer scan runs the inner one over the whole event log. Avoid correlated subqueries and joins of event_log with "
+            "itself that cannot use an index: join on case_concept_name, or aggregate per case in a subquery first and join or filter on its result."
+        )
+
+
+def query_plan(conn, query):
+    """The rows (id, parent, detail) of EXPLAIN QUERY PLAN, raises the error of sqlite for queries that do not compile"""
+    cur = conn.cursor()
+    try:
+        cur.execute("EXPLAIN QUERY PLAN " + query.strip().rstrip(";"))
+        return [(row[0], row[1], row[3]) for row in cur.fetchall()]
+    finally:
+        cur.close()
+
+
+def event_scan_names(conn, query):
+    # the names the plan gives to scans of the events: the table, its aliases in the query, the base table of the view layouts
+    names = {"event_log", BASE_TABLE}
+    names.update(alias.lower() for alias in EVENT_ALIAS_PATTERN.findall(query))
+    if is_view(conn):
+        names.add(VIEW_BASE_ALIAS)
+    return names
+
+
+def _full_scan(detail, names):
+    # SCAN ... USING (COVERING) INDEX still reads every entry of the index
+    match = SCAN_PATTERN.match(detail)
+    return match is not None and match.group(1).lower() in names
+
+
+def _walk(children, parent, outer, names, problems, warnings):
+    # outer: the full scans of the events that run this block once per row
+    scans = []
+    for node_id, detail in children.get(parent, []):
+        if detail.startswith(LOOP_PREFIXES):
+            if _full_scan(detail, names):
+                enclosing = outer + scans
+                if enclosing:
+                    problems.append(f"a full scan of event_log ({detail}) nested in another one ({enclosing[-1]})")
+                scans.append(detail)
+            _walk(children, node_id, outer + scans, names, problems, warnings)
+        elif detail.startswith("CORRELATED"):
+            # runs once per row of the loops before it
+            _walk(children, node_id, outer + scans, names, problems, warnings)
+        elif detail.startswith("USE TEMP B-TREE"):
+            if scans:
+                warnings.append(f"{detail.lower()} over a full scan of event_log ({scans[-1]})")
+        else:
+            # materialized subqueries, co-routines and scalar subqueries that do not depend on the outer row run once
+            _walk(children, node_id, outer, names, problems, warnings)
+
+
+def check_plan(conn, query):
+    """The PlanCheck of query on conn, without running it"""
+    children = {}
+    for node_id, parent, detail in query_plan(conn, query):
+        children.setdefault(parent, []).append((node_id, detail))
+    problems, warnings = [], []
+    _walk(children, 0, [], event_scan_names(conn, query), problems, warnings)
+    return PlanCheck(problems, warnings)
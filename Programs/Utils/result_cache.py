@@ -0,0 +1,103 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# string literals and quoted identifiers are kept as they are, everything else is compared case and whitespace insensitive
+_QUOTED_OR_SPACE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|\s+""")
+# results that change between two runs of the same query on the same data
+_NONDETERMINISTIC = re.compile(r"random\s*\(|randomblob\s*\(|'now'|changes\s*\(|last_insert_rowid\s*\(", re.IGNORECASE)
+
+
+def normalize_query(query):
+    """The cache key of a query: without trailing semicolons, runs of whitespace collapsed and lowercase outside of quotes"""
+    parts = _QUOTED_OR_SPACE.split(query.strip().rstrip(";").strip())
+    # split keeps the quoted groups (every second part), None where the separator was whitespace
+    normalized = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            normalized.append(part.lower())
+        else:
+            normalized.append(part if part is not None else " ")
+    return "".join(normalized)
+
+
+def cacheable(query):
+    # read only queries that return the same rows as long as the database does not change
+    normalized = normalize_query(query)
+    return normalized.startswith(("select", "with")) and ";" not in normalized and not _NONDETERMINISTIC.search(query)
+
+
+class ResultCache:
+    """Rendered result tables of generated queries (see query_execution.QueryResult), keyed by the normalized query, the table size and
+    the version of the database. The version is bumped whenever the column enricher commits or drops a column and when the database is reset
+    to its golden clone, results of older versions are never served again and leave the cache through LRU eviction.
+    Changes by other processes are not seen, the cache is meant for the programs of one notebook."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+
+    def key(self, query, max_length):
+        """The key of query at the current version, None if the result of the query must not be cached"""
+        if not cacheable(query):
+            return None
+        with self._lock:
+            return (self.version, max_length, normalize_query(query))
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            if key[0] != self.version or key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, result):
+        if key is None:
+            return
+        with self._lock:
+            # a column committed while the query ran: the result may already be stale
+            if key[0] != self.version:
+                return
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "version": self.version, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def result_cache_for(database):
+    """One result cache per database file (the conn_path of the column enricher, the database of the connection pool), shared by all program
+    instances and their deepcopies in the evaluation threads"""
+    path = os.path.abspath(database)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResultCache()
+        return _caches[path]
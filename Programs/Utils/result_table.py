@@ -0,0 +1,53 @@
+def _row_text(row):
+    return " | ".join([str(cell) for cell in row])
+
+
+def fetch_rows(cur, max_length=1500, batch_size=100):
+    """Fetches the rows of the executed statement of cur with fetchmany, only as many as fit into the result table of max_length characters
+    (see render_rows), instead of fetchall pulling the whole result into python for a table that keeps the first few rows.
+    Returns (rows, complete), complete is False if the statement has more rows. The caller closes cur, which stops the statement"""
+    length = len("|".join(description[0] for description in cur.description))
+    rows = []
+    while True:
+        batch = cur.fetchmany(batch_size)
+        if not batch:
+            return rows, True
+        for row in batch:
+            row_length = len(_row_text(row)) + 1
+            if length + row_length > max_length:
+                return rows, False
+            rows.append(row)
+            length += row_length
+
+
+def render_rows(column_names, rows, max_length=1500):
+    """The result table of the SQL programs: the header and one line per row, cut off before max_length characters"""
+    result = "|".join(column_names)
+    current_length = len(result)
+    for row in rows:
+        row_data = _row_text(row)
+        if current_length + len(row_data) + 1 > max_length:
+            break  # Keep within the max_length limit.
+        result += " \n" + row_data
+        current_length += len(row_data) + 1
+    return result
+
+
+def render_result(cur, max_length=1500):
+    """The result table of the statement executed on cur, fetched with fetch_rows. Returns (table, shown rows, complete)"""
+    column_names = [description[0] for description in cur.description]
+    rows, complete = fetch_rows(cur, max_length)
+    return render_rows(column_names, rows, max_length), len(rows), complete
+
+
+def count_rows(conn, query):
+    """Total number of rows of query, for results the table cut off. sqlite counts them without building python tuples,
+    None if the query cannot be wrapped (e.g. several statements)"""
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT COUNT(*) FROM ({query.strip().rstrip(';')});")
+        return cur.fetchone()[0]
+    except Exception:
+        return None
+    finally:
+        cur.close()
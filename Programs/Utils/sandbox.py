@@ -0,0 +1,238 @@
+import multiprocessing
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import traceback
+from Utils.event_log_table import CASE_ORDER
+from Utils.dataframe_backend import read_shared_frame, result_frame, start_memory_measure, task_peak_mb
+
+# shared Arrow files of the event log frames handed to the workers
+SHARED_FRAME_DIR = os.path.join(tempfile.gettempdir(), "event_log_frames")
+
+
+class GeneratedCodeError(Exception):
+    """Error raised by generated code in a worker. frames holds the traceback entries, so trace_prettyprint can point at the failing line"""
+
+    def __init__(self, message, frames=None):
+        super().__init__(message)
+        self.frames = frames or []
+
+
+def _limit_memory(memory_mb):
+    # the address space limit stands in for RSS (which no platform enforces), allocations beyond it raise MemoryError in the generated code
+    try:
+        import resource
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        # not supported on this platform (e.g. macOS), the wall clock timeout still applies
+        pass
+
+
+def _limit_cpu(cpu_seconds):
+    # RLIMIT_CPU counts the whole life of the worker, so the limit is moved to the current usage plus the budget of this task.
+    # Crossing it kills the worker (SIGXCPU), the executor replaces that worker
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def _keep_columns(dp, columns):
+    # only what the program needs afterwards goes back through the pipe, the case order columns stand in for a missing row key
+    if not hasattr(dp, "columns"):
+        return None
+    if "idx" not in dp.columns:
+        columns = list(columns) + CASE_ORDER
+    return dp[[c for c in dp.columns if c in columns]]
+
+
+def _result(local_scope, return_columns):
+    return _keep_columns(result_frame(local_scope.get("dp"), list(return_columns) + CASE_ORDER), return_columns)
+
+
+def _run_generated_code(python_code, conn_path, frame_path, return_columns, cpu_seconds, backend="pandas"):
+    # runs in the worker process, returns (dp, error, MB the resident memory of the worker rose by for this task, see task_peak_mb)
+    _limit_cpu(cpu_seconds)
+    start_mb = start_memory_measure()
+    # other enrichments may be writing at the same time, wait for them like the programs do
+    conn = sqlite3.connect(conn_path, timeout=60)
+    local_scope = {"conn": conn, "cur": conn.cursor()}
+    try:
+        if frame_path is not None:
+            local_scope["dp"] = read_shared_frame(backend, frame_path)
+        exec(compile(python_code, "<string>", "exec"), {"__name__": "__sandbox__"}, local_scope)
+        return _result(local_scope, return_columns), None, task_peak_mb(start_mb)
+    except Exception as e:
+        frames = [(frame.filename, frame.lineno) for frame in traceback.extract_tb(e.__traceback__)]
+        return _result(local_scope, return_columns), (str(e), frames), task_peak_mb(start_mb)
+    finally:
+        conn.close()
+
+
+def _worker_main(conn, memory_mb):
+    # a worker process runs the tasks sent through its pipe one after the other, until the pipe is closed or it gets None
+    _limit_memory(memory_mb)
+    # the imports are done, the time limits of the first task do not pay for the start of the worker
+    conn.send(os.getpid())
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        dp, error, peak_mb = _run_generated_code(*task)
+        try:
+            conn.send((dp, error, peak_mb))
+        except Exception as e:
+            # e.g. a result that cannot be pickled
+            conn.send((None, (str(e), []), peak_mb))
+
+
+class _Frame:
+    # the parts of traceback.FrameSummary trace_prettyprint uses
+    def __init__(self, filename, lineno):
+        self.filename = filename
+        self.lineno = lineno
+
+
+class _Worker:
+    # one worker process and the pipe to it, the executor hands it to one task at a time
+    def __init__(self, context, memory_mb):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_mb), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn.recv()
+
+    def stop(self):
+        # a stuck worker does not stop on its own
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        self.stop()
+
+
+class SandboxExecutor:
+    """Runs generated enrichment code in worker processes instead of the notebook process.
+    Every task gets cpu_seconds of CPU time, wall_seconds of wall clock time and memory_mb of address space, a runaway groupby or cross join
+    only takes down its own worker: each task has a worker (and pipe) to itself, a stopped or killed worker is replaced without touching the tasks
+    of concurrent enrichments. The event log frame is handed over as a memory mapped Arrow file, results only carry the columns asked for."""
+
+    def __init__(self, max_workers=None, cpu_seconds=300, wall_seconds=600, memory_mb=16384):
+        # one worker per enrichment that can run concurrently, bounded by the cores
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.memory_mb = memory_mb
+        # spawn: workers never inherit the locks, connections and threads of the notebook process
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._started = 0
+
+    def run(self, python_code, conn_path, frame_path=None, return_columns=(), backend="pandas", stats=None):
+        """Executes python_code with conn, cur and (if frame_path is given) dp in its scope, dp as a frame of backend (see dataframe_backend.py).
+        Returns (pandas dp restricted to return_columns or None, GeneratedCodeError or None). A stats dict gets the peak_rss_mb of the task.
+        Waits for a free worker if max_workers tasks are running, the time limits start once the task is in its worker"""
+        worker = self._acquire()
+        try:
+            worker.conn.send((python_code, conn_path, frame_path, list(return_columns), self.cpu_seconds, backend))
+            # poll also returns once the worker died, recv then raises EOFError
+            if not worker.conn.poll(self.wall_seconds):
+                self._replace(worker)
+                worker = None
+                return None, GeneratedCodeError(f"Execution took longer than {self.wall_seconds} seconds and was stopped")
+            dp, error, peak_mb = worker.conn.recv()
+        except (EOFError, OSError):
+            # SIGXCPU at the cpu limit, or killed when it ran out of memory
+            self._replace(worker)
+            worker = None
+            return None, GeneratedCodeError(f"Execution was stopped, it used more than {self.cpu_seconds} seconds of CPU time or {self.memory_mb} MB of memory")
+        except Exception as e:
+            # e.g. a task that cannot be pickled
+            return None, GeneratedCodeError(str(e))
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+        if stats is not None:
+            stats["peak_rss_mb"] = peak_mb
+        if error is not None:
+            message, frames = error
+            return dp, GeneratedCodeError(message, [_Frame(filename, lineno) for filename, lineno in frames])
+        return dp, None
+
+    def shutdown(self):
+        """Stops the idle workers, workers that are running a task are stopped once it is done"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
+            with self._lock:
+                self._started -= 1
+
+    def _acquire(self):
+        # an idle worker, a new one while fewer than max_workers are started, otherwise the next one that becomes idle
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    start = self._started < self.max_workers
+                    if start:
+                        self._started += 1
+                if start:
+                    try:
+                        return _Worker(self._context, self.memory_mb)
+                    except Exception:
+                        with self._lock:
+                            self._started -= 1
+                        raise
+                worker = self._idle.get()
+            if worker.process.is_alive():
+                return worker
+            # died while idle
+            worker.stop()
+            with self._lock:
+                self._started -= 1
+
+    def _replace(self, worker):
+        # only the worker of this task is stopped, a fresh one takes its place for the tasks waiting for a worker
+        worker.stop()
+        try:
+            self._idle.put(_Worker(self._context, self.memory_mb))
+        except Exception:
+            with self._lock:
+                self._started -= 1
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def sandbox_executor(**kwargs):
+    """The executor shared by all program instances (and their deepcopies in the evaluation threads)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = SandboxExecutor(**kwargs)
+        return _executor
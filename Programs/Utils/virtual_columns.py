@@ -0,0 +1,145 @@
+import re
+import time
+from Utils.column_dependency import vanilla_cols
+from Utils.column_writeback import savepoint
+from Utils.event_log_view import register_virtual_column
+from Utils.case_templates import NAME_PATTERN
+
+# ... defined as "amount_last" + "expense_sum" - "maxtotalPaymentAmount"
+ARITHMETIC_PATTERN = re.compile(r'defined as (?P<expression>"\w+"(?:\s*[+-]\s*"\w+")+)', re.IGNORECASE)
+# ... TRUE if "outstanding_balance" <= 0 / TRUE if on a per case basis, the column "outstanding_balance" is smaller than 0
+COMPARISON_PATTERN = re.compile(
+    r'TRUE if (?:and only if )?(?:per case |on a per case basis, )?(?:the column )?"(?P<column>\w+)"\s*'
+    r'(?P<op><=|>=|<|>|is smaller equal to|is larger equal to|is smaller than|is larger than)\s*(?P<value>-?\d+)'
+)
+# ... TRUE if the column "appealed_to_judge" == TRUE AND the column "dismissed_by_judge" == FALSE
+CONJUNCTION_PATTERN = re.compile(r'TRUE if the column "(?P<a>\w+)" == (?P<va>TRUE|FALSE) AND the column "(?P<b>\w+)" == (?P<vb>TRUE|FALSE)')
+# ... TRUE if per case any of the rows are TRUE in the column "dismissed" and TRUE for the column "credit_collected"
+BOTH_TRUE_PATTERN = re.compile(r'TRUE in the column "(?P<a>\w+)" and TRUE for the column "(?P<b>\w+)"')
+# ... TRUE if on a per case basis the column "fully_paid" AND "credit_collected" AND "dismissed" are == FALSE
+NONE_TRUE_PATTERN = re.compile(r'the column (?P<columns>"\w+"(?:\s*AND\s*"\w+")+)\s*are (?:equal to|==) FALSE')
+# ... Defined as 0 if the column "overpaid" == FALSE. If "overpaid" == TURE it is the difference between 0 and the column "outstanding_balance"
+CONDITIONAL_PATTERN = re.compile(r'Defined as 0 if the column "(?P<flag>\w+)" == FALSE')
+ABSOLUTE_PATTERN = re.compile(r'difference between 0 and the column "(?P<value>\w+)"')
+VALUE_PATTERN = re.compile(r'equal to the value of the column "(?P<value>\w+)"')
+
+OPERATORS = {"<=": "<=", ">=": ">=", "<": "<", ">": ">",
+             "is smaller equal to": "<=", "is larger equal to": ">=", "is smaller than": "<", "is larger than": ">"}
+
+
+class VirtualColumn:
+    """A derived column computed by the event_log view from other enriched columns (arithmetic or boolean combinations of them), instead of
+    being generated, stored and written back"""
+
+    def __init__(self, column, sql_type, expression, parents, description):
+        self.column = column
+        self.sql_type = sql_type
+        # SQL over the quoted parent columns, e.g. "amount_last" + "expense_sum" - "maxtotalPaymentAmount"
+        self.expression = expression
+        self.parents = parents
+        self.description = description
+
+    def code(self):
+        # what goes into the code history of the program instead of generated python
+        return f'-- virtual column of the event_log view\nSELECT {self.expression} AS "{self.column}" FROM event_log;'
+
+
+def _names(text):
+    return re.findall(r'"(\w+)"', text)
+
+
+def _flag(column, value):
+    return f'"{column}"' if value == "TRUE" else f'NOT "{column}"'
+
+
+def _match(instruction, column, is_bool):
+    # (sql type, expression, parents, description) for the shapes of derived columns, None for everything else
+    if not is_bool:
+        match = ARITHMETIC_PATTERN.search(instruction)
+        if match:
+            expression = match.group("expression")
+            shown = re.sub(r'"(\w+)"', r"'\1'", expression)
+            return "INTEGER", expression, _names(expression), f"- '{column}' (int): {shown} per case, the same value for all rows of a case."
+        match = CONDITIONAL_PATTERN.search(instruction)
+        value = ABSOLUTE_PATTERN.search(instruction) or VALUE_PATTERN.search(instruction)
+        if match and value:
+            flag, source = match.group("flag"), value.group("value")
+            shown = f"the absolute value of '{source}'" if value.re is ABSOLUTE_PATTERN else f"'{source}'"
+            source = f'ABS("{source}")' if value.re is ABSOLUTE_PATTERN else f'"{source}"'
+            return (
+                "INTEGER", f'CASE WHEN "{flag}" THEN {source} ELSE 0 END', [flag, value.group("value")],
+                f"- '{column}' (int): {shown} if '{flag}' is TRUE, 0 otherwise. The same value for all rows of a case.",
+            )
+        return None
+
+    match = COMPARISON_PATTERN.search(instruction)
+    if match:
+        source, op, value = match.group("column"), OPERATORS[match.group("op")], int(match.group("value"))
+        return (
+            "BOOLEAN", f'"{source}" {op} {value}', [source],
+            f"- '{column}' (boolean): TRUE if '{source}' {op} {value}, FALSE otherwise. The same value for all rows of a case.",
+        )
+    match = CONJUNCTION_PATTERN.search(instruction)
+    if match:
+        a, b = match.group("a"), match.group("b")
+        return (
+            "BOOLEAN", f"{_flag(a, match.group('va'))} AND {_flag(b, match.group('vb'))}", [a, b],
+            f"- '{column}' (boolean): TRUE if '{a}' is {match.group('va')} and '{b}' is {match.group('vb')}, FALSE otherwise. The same value for all rows of a case.",
+        )
+    match = BOTH_TRUE_PATTERN.search(instruction)
+    if match:
+        a, b = match.group("a"), match.group("b")
+        return (
+            "BOOLEAN", f'"{a}" AND "{b}"', [a, b],
+            f"- '{column}' (boolean): TRUE if both '{a}' and '{b}' are TRUE, FALSE otherwise. The same value for all rows of a case.",
+        )
+    match = NONE_TRUE_PATTERN.search(instruction)
+    if match:
+        parents = _names(match.group("columns"))
+        shown = ", ".join(f"'{c}'" for c in parents)
+        return (
+            "BOOLEAN", " AND ".join(f'NOT "{c}"' for c in parents), parents,
+            f"- '{column}' (boolean): TRUE if none of {shown} is TRUE, FALSE otherwise. The same value for all rows of a case.",
+        )
+    return None
+
+
+def match_virtual(instruction, table_columns):
+    """The VirtualColumn for instructions that combine columns the enricher created before (per case values, so a row wise expression keeps them
+    the same for all rows of a case), None for everything else, which is generated as usual"""
+    name = NAME_PATTERN.search(instruction)
+    if name is None:
+        return None
+    column = name.group("name")
+    matched = _match(instruction, column, "boolean" in instruction.lower())
+    if matched is None:
+        return None
+    sql_type, expression, parents, description = matched
+    # only combinations of enriched columns: the columns of the log itself differ within a case
+    if not all(p in table_columns and p not in vanilla_cols for p in parents):
+        return None
+    return VirtualColumn(column, sql_type, expression, parents, description)
+
+
+class _Incomplete(Exception):
+    pass
+
+
+def apply_virtual(conn, virtual):
+    """Registers virtual as a column of the event_log view. Returns the number of rows where it is NULL (a parent is missing values),
+    the registration is then rolled back (0 if the column is complete). The caller holds the write lock"""
+    start = time.perf_counter()
+    missing = 0
+    try:
+        with savepoint(conn):
+            register_virtual_column(conn, virtual.column, virtual.expression)
+            cur = conn.cursor()
+            cur.execute(f'SELECT COUNT(*) FROM event_log WHERE "{virtual.column}" IS NULL;')
+            missing = cur.fetchone()[0]
+            cur.close()
+            if missing:
+                raise _Incomplete()
+    except _Incomplete:
+        return missing
+    print(f"registered {virtual.column} as a virtual column of event_log in {time.perf_counter() - start:.2f}s")
+    return missing
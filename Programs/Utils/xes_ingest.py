@@ -0,0 +1,273 @@
+import gzip
+import sqlite3
+from datetime import datetime, timezone
+from lxml import etree
+
+# bump whenever the cleaning below changes, cached event logs (event_log_cache.py) are keyed by it
+CLEANING_VERSION = 2
+
+# columns holding euro values, stored as integer cents (same as the notebook preprocessing)
+CENT_COLUMNS = ["amount", "expense", "paymentAmount", "totalPaymentAmount"]
+
+# sqlite type that pandas.to_sql would have picked for each xes attribute type
+XES_SQL_TYPES = {
+    "string": "TEXT",
+    "id": "TEXT",
+    "date": "TIMESTAMP",
+    "int": "INTEGER",
+    "float": "REAL",
+    "boolean": "INTEGER",
+}
+
+
+_local_names = {}
+
+
+def _local(tag):
+    # strip the xes namespace, "{http://www.xes-standard.org/}event" -> "event" (memoized, there are only a handful of tags)
+    name = _local_names.get(tag)
+    if name is None:
+        name = tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+        _local_names[tag] = name
+    return name
+
+
+def _open(xes_path):
+    if str(xes_path).endswith(".gz"):
+        return gzip.open(xes_path, "rb")
+    return open(xes_path, "rb")
+
+
+def clean_column_name(key):
+    # "case:concept:name" -> "case_concept_name"
+    return key.replace(":", "_")
+
+
+def convert_value(xes_type, value):
+    if value is None:
+        return None
+    if xes_type == "int":
+        return int(value)
+    if xes_type == "float":
+        return float(value)
+    if xes_type == "boolean":
+        return 1 if value.lower() == "true" else 0
+    if xes_type == "date":
+        # pm4py parses timestamps as UTC, to_sql stores them as "YYYY-MM-DD HH:MM:SS+00:00"
+        ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return ts.astimezone(timezone.utc).isoformat(" ")
+    return value
+
+
+def to_cents(value):
+    # fillna(0), * 100, astype(int)
+    if value is None:
+        return 0
+    return int(value * 100)
+
+
+def _attributes(elem, prefix=""):
+    # flat attributes directly below elem, nested attributes (lists, containers) are skipped
+    attrs = {}
+    for child in elem:
+        xes_type = _local(child.tag)
+        if xes_type in XES_SQL_TYPES and child.get("key") is not None:
+            attrs[prefix + child.get("key")] = (xes_type, child.get("value"))
+    return attrs
+
+
+def iter_xes_events(xes_path):
+    """Yields one dict per event (trace attributes prefixed with "case:") together with the xes type of every attribute, without building the whole log in memory"""
+    with _open(xes_path) as f:
+        # only the closing tags of events and traces are reported, <global> defaults are never touched
+        context = etree.iterparse(f, events=("end",), tag=("{*}event", "{*}trace"), huge_tree=True)
+        trace_events = []
+        for _, elem in context:
+            if _local(elem.tag) == "event":
+                trace_events.append(_attributes(elem))
+                elem.clear()
+                continue
+            # trace attributes may appear after the events, so events are emitted once the trace is closed
+            trace_attrs = _attributes(elem, prefix="case:")
+            for event in trace_events:
+                event.update(trace_attrs)
+                yield event
+            trace_events = []
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        del context
+
+
+class SchemaInference:
+    """The schema of the events seen so far: every attribute, its xes type and how many events have it. It only grows and widens as more
+    events are seen (new attributes, int / float / other types mixed, int attributes that turn out to be missing for some events)"""
+
+    def __init__(self):
+        self.types = {}
+        self.counts = {}
+        self.num_events = 0
+
+    def observe(self, event):
+        self.num_events += 1
+        for key, (xes_type, _) in event.items():
+            if key not in self.types:
+                self.types[key] = xes_type
+            elif self.types[key] != xes_type:
+                # mixed int/float attributes end up as float in pandas, anything else as object
+                self.types[key] = "float" if {self.types[key], xes_type} <= {"int", "float"} else "string"
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def schema(self):
+        """A list of (column_name, sql_type)"""
+        # event attributes first, then case attributes (same order as pm4py)
+        keys = [k for k in self.types if not k.startswith("case:")] + [k for k in self.types if k.startswith("case:")]
+        schema = []
+        for key in keys:
+            name = clean_column_name(key)
+            sql_type = XES_SQL_TYPES[self.types[key]]
+            if name in CENT_COLUMNS:
+                sql_type = "INTEGER"
+            elif self.types[key] == "int" and self.counts[key] < self.num_events:
+                # pandas turns int columns with missing values into float64
+                sql_type = "REAL"
+            schema.append((name, sql_type))
+        return schema
+
+
+def scan_xes_schema(xes_path):
+    """Streams through the log once to find every attribute, its xes type and whether it is missing for some events. Returns a list of (column_name, sql_type)"""
+    inference = SchemaInference()
+    for event in iter_xes_events(xes_path):
+        inference.observe(event)
+    return inference.schema()
+
+
+def _text_value(xes_type, value):
+    # a value of an attribute whose types are mixed (TEXT column): the string of the cleaned value, what pandas' object column stores as TEXT
+    value = convert_value(xes_type, value)
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def event_rows(events, schema):
+    """Yields cleaned event tuples ordered like the schema (renamed columns, cents conversion, strings in TEXT columns)"""
+    names = [name for name, _ in schema]
+    cent_positions = [i for i, name in enumerate(names) if name in CENT_COLUMNS]
+    text_columns = {name for name, sql_type in schema if sql_type == "TEXT"}
+    for event in events:
+        values = {}
+        for key, (xes_type, value) in event.items():
+            name = clean_column_name(key)
+            values[name] = _text_value(xes_type, value) if name in text_columns else convert_value(xes_type, value)
+        row = [values.get(name) for name in names]
+        for i in cent_positions:
+            row[i] = to_cents(row[i])
+        yield row
+
+
+def iter_event_rows(xes_path, schema):
+    return event_rows(iter_xes_events(xes_path), schema)
+
+
+def iter_event_batches(xes_path, schema, batch_size=50000):
+    batch = []
+    for row in iter_event_rows(xes_path, schema):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_inferred_batches(xes_path, batch_size=50000):
+    """Streams the log once without knowing its schema up front. Yields (schema, batch): the schema of all events up to the end of the batch
+    (see SchemaInference) and the batch as row tuples ordered like it. The schema of the last batch is the schema of the whole log"""
+    inference = SchemaInference()
+    events = []
+    for event in iter_xes_events(xes_path):
+        inference.observe(event)
+        events.append(event)
+        if len(events) >= batch_size:
+            schema = inference.schema()
+            yield schema, list(event_rows(events, schema))
+            events = []
+    if events:
+        schema = inference.schema()
+        yield schema, list(event_rows(events, schema))
+
+
+def _create_table(cur, table, schema):
+    columns_sql = ", ".join(f'"{name}" {sql_type}' for name, sql_type in schema)
+    cur.execute(f"DROP TABLE IF EXISTS {table};")
+    cur.execute(f"CREATE TABLE {table} ({columns_sql});")
+
+
+def write_event_batches(conn, schema, batches, table="event_log"):
+    """Creates (or replaces) table with the given schema and bulk inserts the batches of row tuples. Returns the number of inserted rows"""
+    cur = conn.cursor()
+    _create_table(cur, table, schema)
+    placeholders = ", ".join("?" for _ in schema)
+    insert = f"INSERT INTO {table} VALUES ({placeholders});"
+
+    num_rows = 0
+    for batch in batches:
+        cur.executemany(insert, batch)
+        num_rows += len(batch)
+    conn.commit()
+    cur.close()
+    return num_rows
+
+
+def write_inferred_batches(conn, batches, table="event_log"):
+    """Creates (or replaces) table from the (schema, batch) pairs of iter_inferred_batches. The table starts with the schema of the first batch,
+    later attributes are added as columns. Only if the final schema differs from that (other types or column order) the table is copied once
+    into the final layout, sqlite cannot change declared types in place. Returns the number of inserted rows"""
+    cur = conn.cursor()
+    layout = None
+    num_rows = 0
+    schema = []
+    for schema, batch in batches:
+        if layout is None:
+            _create_table(cur, table, schema)
+            layout = list(schema)
+        known = {name for name, _ in layout}
+        for name, sql_type in schema:
+            if name not in known:
+                # events before the first one with this attribute: NULL, 0 for the euro columns (same as to_cents)
+                default = " DEFAULT 0" if name in CENT_COLUMNS else ""
+                cur.execute(f'ALTER TABLE {table} ADD COLUMN "{name}" {sql_type}{default};')
+                layout.append((name, sql_type))
+        columns = ", ".join(f'"{name}"' for name, _ in schema)
+        placeholders = ", ".join("?" for _ in schema)
+        cur.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders});", batch)
+        num_rows += len(batch)
+
+    if layout is not None and layout != schema:
+        staging = f"{table}__typed"
+        columns = ", ".join(f'"{name}"' for name, _ in schema)
+        _create_table(cur, staging, schema)
+        # the declared types of the staging table convert the values like the final schema would have on insert
+        cur.execute(f"INSERT INTO {staging} ({columns}) SELECT {columns} FROM {table} ORDER BY rowid;")
+        cur.execute(f"DROP TABLE {table};")
+        cur.execute(f"ALTER TABLE {staging} RENAME TO {table};")
+    conn.commit()
+    cur.close()
+    return num_rows
+
+
+def ingest_xes(xes_path, conn, table="event_log", schema=None, batch_size=50000):
+    """Streams an xes file into a sqlite table in bulk batches, replacing the table if it exists.
+    Applies the same preprocessing as the notebooks (":" -> "_" in column names, euro columns as integer cents).
+    Without a schema the file is parsed once and the column types are inferred while inserting (see write_inferred_batches).
+    Peak memory is bounded by batch_size instead of the size of the log. Returns the number of inserted events."""
+    if isinstance(conn, str):
+        conn = sqlite3.connect(conn)
+    if schema is None:
+        num_rows = write_inferred_batches(conn, iter_inferred_batches(xes_path, batch_size), table)
+    else:
+        num_rows = write_event_batches(conn, schema, iter_event_batches(xes_path, schema, batch_size), table)
+    print(f"ingested {num_rows} events into {table}")
+    return num_rows